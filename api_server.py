@@ -0,0 +1,458 @@
+"""
+HTTP API генерации для интеграций (без интерфейса Streamlit).
+
+    python api_server.py --port 8080
+
+POST /v1/jobs                - multipart: images (1-10 файлов), prompt, toggles, customer_id
+GET  /v1/jobs/<job_id>        - статус задания
+GET  /v1/jobs/<job_id>/result - изображение-результат
+GET  /healthz                 - состояние очереди и внешних сервисов
+"""
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+import profiling
+import resilience
+from app import (
+    IMAGES_FOLDER,
+    TOGGLE_TEXTS,
+    ImageGenerator,
+    build_prompt,
+    generation_key,
+    get_references,
+    get_shared_state,
+    get_single_flight,
+    record_generation,
+    run_generation,
+    upload_and_verify,
+)
+from image_dedup import find_duplicates, perceptual_hashes
+from reference_transport import split_references
+from upload_pipeline import get_pipeline
+
+logger = logging.getLogger(__name__)
+
+API_HOST = os.environ.get("API_HOST", "0.0.0.0")
+API_PORT = int(os.environ.get("API_PORT", "8080"))
+# Сколько заданий выполняется одновременно
+API_WORKERS = int(os.environ.get("API_WORKERS", "4"))
+# Сколько заданий может ждать в очереди; сверх этого API отвечает 429
+API_QUEUE_SIZE = int(os.environ.get("API_QUEUE_SIZE", "20"))
+# Максимальный размер тела запроса
+API_MAX_REQUEST_MB = int(os.environ.get("API_MAX_REQUEST_MB", "100"))
+# Если задан, запросы должны передавать заголовок Authorization: Bearer <токен>
+API_TOKEN = os.environ.get("API_TOKEN", "")
+# Через сколько секунд повторить запрос после 429
+API_RETRY_AFTER = 10
+
+MAX_REFERENCES = 10
+MAX_IMAGE_SIZE = 32 * 1024 * 1024
+
+
+class RequestError(Exception):
+    """Некорректный запрос клиента API"""
+
+    def __init__(self, status: int, error: str, message: str):
+        super().__init__(message)
+        self.status = status
+        self.error = error
+        self.message = message
+
+
+def parse_multipart(content_type: str, body: bytes) -> Tuple[dict, List[Tuple[str, bytes]]]:
+    """Разбирает multipart/form-data: возвращает текстовые поля и файлы (имя, содержимое)"""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body
+    )
+    if not message.is_multipart():
+        raise RequestError(400, "invalid_multipart", "Ожидается multipart/form-data")
+
+    fields, files = {}, []
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        data = part.get_payload(decode=True) or b""
+        if part.get_filename() is not None:
+            files.append((part.get_filename(), data))
+        elif name:
+            try:
+                fields[name] = data.decode("utf-8")
+            except UnicodeDecodeError:
+                raise RequestError(400, "invalid_field_encoding", f"Поле {name} должно быть в кодировке UTF-8")
+    return fields, files
+
+
+def parse_job_request(fields: dict, files: List[Tuple[str, bytes]]) -> dict:
+    """Проверяет поля задания и возвращает его параметры"""
+    if not files:
+        raise RequestError(400, "REFERENCES_URLS_IS_EMPTY", "Не переданы изображения")
+    if len(files) > MAX_REFERENCES:
+        raise RequestError(400, "too_many_images", f"Можно передать не более {MAX_REFERENCES} изображений")
+
+    for name, data in files:
+        if len(data) > MAX_IMAGE_SIZE:
+            raise RequestError(413, "image_too_large", f"{name} превышает 32 МБ")
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                image.verify()
+        except Exception:
+            raise RequestError(400, "invalid_image", f"{name} не является изображением")
+
+    toggle_names = [t.strip() for t in fields.get("toggles", "").split(",") if t.strip()]
+    unknown = [t for t in toggle_names if t not in TOGGLE_TEXTS]
+    if unknown:
+        raise RequestError(400, "unknown_toggles",
+                           f"Неизвестные тумблеры: {', '.join(unknown)}. Доступны: {', '.join(TOGGLE_TEXTS)}")
+
+    customer_id = fields.get("customer_id", "")
+    if customer_id and not customer_id.isalnum():
+        raise RequestError(400, "CUSTOMER_ID_NOT_VALID", "Неверный формат ID клиента")
+
+    return {
+        "prompt": fields.get("prompt", ""),
+        "toggles": {name: name in toggle_names for name in TOGGLE_TEXTS},
+        "customer_id": customer_id or str(uuid.uuid4())[:8],
+        "images": files
+    }
+
+
+def prepare_references(images: List[Tuple[str, bytes]]) -> List[dict]:
+    """
+    Запускает параллельную загрузку референсов задания (с учетом общего кэша загрузок);
+    генерация дождется ее. Изображения, которые поместятся в лимит встроенных референсов,
+    не загружаются, почти-дубликаты внутри задания представлены оригиналом.
+    """
+    references = []
+    # Оригинал каждого изображения (для оригинала - оно само)
+    originals = []
+    phashes = perceptual_hashes([data for _, data in images])
+    # Известных изображений нет: индекс совпадения - номер более раннего изображения задания
+    matches = find_duplicates(phashes, [])
+
+    for (name, data), phash, match in zip(images, phashes, matches):
+        content_hash = hashlib.sha256(data).hexdigest()
+        original = originals[match] if match is not None else None
+
+        references.append({
+            "name": name,
+            "url": None,
+            "upload": None,
+            "verified": False,
+            "bytes": data,
+            "content_hash": content_hash,
+            "ref_key": original["ref_key"] if original else content_hash,
+            "phash": phash,
+            "duplicate_of": original["name"] if original else None
+        })
+        originals.append(original or references[-1])
+
+    # Загружаем все, что не будет встроено в запрос (с учетом общего лимита встроенных)
+    _, by_url = split_references([ref for ref in references if not ref["duplicate_of"]])
+    pending = {id(ref) for ref in by_url}
+    shared_state = get_shared_state()
+    for i, ref in enumerate(references):
+        if id(ref) in pending:
+            ref["upload"] = get_pipeline().submit(upload_and_verify, ref["bytes"], ref["name"],
+                                                  ref["content_hash"], i, shared_state)
+    for ref, original in zip(references, originals):
+        ref["upload"] = original["upload"]
+    return references
+
+
+class JobRunner:
+    """
+    Ограниченный пул обработчиков заданий. Очередь ограничена:
+    если она заполнена, задание не принимается (клиент получает 429).
+    """
+
+    def __init__(self, workers: int = API_WORKERS, queue_size: int = API_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"api-worker-{i}", daemon=True).start()
+
+    def submit(self, job: dict, request: dict) -> bool:
+        """
+        Ставит задание в очередь; False, если очередь заполнена.
+        Обработчик получает копию: он меняет статус, пока вызывающий еще отвечает клиенту
+        """
+        shared_state = get_shared_state()
+        shared_state.put_job(job["job_id"], job)
+        try:
+            self.queue.put_nowait((dict(job), request))
+            return True
+        except queue.Full:
+            job.update(status="rejected", updated_at=time.time())
+            shared_state.put_job(job["job_id"], job)
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            active = self.active
+        return {
+            "workers": self.workers,
+            "active": active,
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue_size
+        }
+
+    def _worker(self):
+        generator = ImageGenerator()
+        while True:
+            job, request = self.queue.get()
+            with self._lock:
+                self.active += 1
+            try:
+                process_job(generator, job, request)
+            except Exception as e:
+                logger.error(f"Ошибка выполнения задания {job['job_id']}: {e}", exc_info=True)
+                update_job(job, status="failed", error=str(e))
+            finally:
+                with self._lock:
+                    self.active -= 1
+                self.queue.task_done()
+
+
+def update_job(job: dict, **fields):
+    job.update(fields)
+    job["updated_at"] = time.time()
+    get_shared_state().put_job(job["job_id"], job)
+
+
+@profiling.profiled()
+def process_job(generator: ImageGenerator, job: dict, request: dict):
+    """Полный цикл задания: загрузка референсов, генерация, запись в историю"""
+    customer_id = request["customer_id"]
+    update_job(job, status="uploading")
+
+    references = get_references(prepare_references(request["images"]))
+    final_prompt = build_prompt(request["prompt"], request["toggles"])
+    metadata = {
+        "toggles": request["toggles"],
+        "reference_hashes": list(dict.fromkeys(ref["content_hash"] for ref in references))
+    }
+
+    update_job(job, status="generating")
+    result, shared = get_single_flight().do(
+        generation_key(final_prompt, references),
+        run_generation,
+        generator,
+        final_prompt,
+        references,
+        customer_id,
+        on_submitted=lambda task_id: update_job(job, task_id=task_id),
+        metadata=metadata
+    )
+
+    if shared and result.get("task_id"):
+        get_shared_state().link_customer_task(customer_id, result["task_id"])
+
+    if "error" in result:
+        update_job(job, status="failed", task_id=result.get("task_id"), error=result["error"])
+        return
+
+    record_generation(customer_id, result, {"prompt": final_prompt, "created_at": job["created_at"], **metadata})
+    update_job(
+        job,
+        status="succeeded",
+        task_id=result["task_id"],
+        image_url=result["image_url"],
+        timings=result.get("timings")
+    )
+
+
+def make_handler(runner: JobRunner, max_request_bytes: int):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def _send_json(self, payload: dict, status: int = 200, headers: Optional[dict] = None):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_error(self, status: int, error: str, message: str, headers: Optional[dict] = None):
+            self._send_json({"error": error, "message": message}, status, headers)
+
+        def _authorized(self) -> bool:
+            if not API_TOKEN:
+                return True
+            token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+            # compare_digest не принимает строки с не-ASCII символами. http.server декодирует
+            # заголовки как ISO-8859-1, поэтому так получаем исходные байты заголовка
+            return hmac.compare_digest(token.encode("iso-8859-1"), API_TOKEN.encode("utf-8"))
+
+        def _job_response(self, job: dict) -> dict:
+            response = dict(job)
+            response["status_url"] = f"/v1/jobs/{job['job_id']}"
+            if job["status"] == "succeeded":
+                response["result_url"] = f"/v1/jobs/{job['job_id']}/result"
+            return response
+
+        def do_POST(self):
+            if not self._authorized():
+                self._send_error(401, "unauthorized", "Неверный токен API")
+                return
+            if self.path.rstrip("/") != "/v1/jobs":
+                self._send_error(404, "not_found", "Неизвестный адрес")
+                return
+
+            length = self.headers.get("Content-Length")
+            if length is None:
+                self._send_error(411, "length_required", "Нужен заголовок Content-Length")
+                return
+            # Границы тела неизвестны - соединение дальше использовать нельзя
+            if not (length.strip().isascii() and length.strip().isdigit()):
+                self._send_error(400, "invalid_content_length", "Некорректный заголовок Content-Length")
+                self.close_connection = True
+                return
+            length = int(length)
+            if length > max_request_bytes:
+                self._send_error(413, "request_too_large", "Слишком большой запрос")
+                self.close_connection = True
+                return
+
+            # Очередь заполнена - отказываем до чтения тела, чтобы не тратить память и время
+            if runner.queue.full():
+                self._reject_busy()
+                self.close_connection = True
+                return
+
+            body = self.rfile.read(length)
+            try:
+                content_type = self.headers.get("Content-Type", "")
+                if not content_type.startswith("multipart/form-data"):
+                    raise RequestError(415, "unsupported_media_type", "Ожидается multipart/form-data")
+                request = parse_job_request(*parse_multipart(content_type, body))
+            except RequestError as e:
+                self._send_error(e.status, e.error, e.message)
+                return
+
+            now = time.time()
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "status": "queued",
+                "customer_id": request["customer_id"],
+                "task_id": None,
+                "created_at": now,
+                "updated_at": now
+            }
+            if not runner.submit(job, request):
+                self._reject_busy()
+                return
+
+            logger.info(f"Задание {job['job_id']} принято: {len(request['images'])} изображений")
+            self._send_json(self._job_response(job), 202, {"Location": f"/v1/jobs/{job['job_id']}"})
+
+        def _reject_busy(self):
+            self._send_error(429, "queue_full", "Очередь заданий заполнена, повторите позже",
+                             {"Retry-After": str(API_RETRY_AFTER)})
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0].rstrip("/")
+
+            if path == "/healthz":
+                self._send_json({
+                    "status": "ok",
+                    **runner.stats(),
+                    "services": resilience.get_client().status()
+                })
+                return
+
+            if not self._authorized():
+                self._send_error(401, "unauthorized", "Неверный токен API")
+                return
+
+            parts = path.split("/")
+            if len(parts) not in (4, 5) or parts[1:3] != ["v1", "jobs"] or \
+                    (len(parts) == 5 and parts[4] != "result"):
+                self._send_error(404, "not_found", "Неизвестный адрес")
+                return
+
+            job = get_shared_state().get_job(parts[3])
+            if not job:
+                self._send_error(404, "job_not_found", "Задание не найдено")
+                return
+
+            if len(parts) == 4:
+                self._send_json(self._job_response(job))
+                return
+
+            if job["status"] != "succeeded":
+                self._send_json({"error": "not_ready", "message": "Результат еще не готов",
+                                 "status": job["status"]}, 409)
+                return
+
+            local_path = get_shared_state().load_result_file(job["task_id"], IMAGES_FOLDER)
+            if not local_path:
+                self._send_error(410, "result_expired", "Файл результата больше недоступен")
+                return
+
+            with open(local_path, "rb") as f:
+                data = f.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Content-Disposition", f'inline; filename="{job["job_id"]}.jpg"')
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+def create_server(host: str = API_HOST, port: int = API_PORT, workers: int = API_WORKERS,
+                  queue_size: int = API_QUEUE_SIZE) -> Tuple[ThreadingHTTPServer, JobRunner]:
+    runner = JobRunner(workers, queue_size)
+    server = ThreadingHTTPServer((host, port), make_handler(runner, API_MAX_REQUEST_MB * 1024 * 1024))
+    server.daemon_threads = True
+    runner.start()
+    return server, runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP API генерации изображений")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="одновременно выполняемых заданий")
+    parser.add_argument("--queue-size", type=int, default=API_QUEUE_SIZE, help="заданий в очереди до отказа 429")
+    args = parser.parse_args()
+
+    server, runner = create_server(args.host, args.port, args.workers, args.queue_size)
+    logger.info(f"HTTP API запущен на {args.host}:{args.port}, обработчиков: {args.workers}, "
+                f"очередь: {args.queue_size}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,19 @@ import base64
 import io
 import time
 from PIL import Image
-from typing import List, Optional
+from typing import Callable, List, Optional, Tuple
 import uuid
 import os
+import hashlib
+import hmac
+import profiling
+import resilience
+from shared_state import SharedState, create_backend, SHARED_STATE_URL
+from image_dedup import perceptual_hashes, find_duplicates
+from singleflight import SingleFlight
+from history import GenerationHistory, create_history, HISTORY_DB_PATH
+from reference_transport import InlineTransport, UrlTransport, can_inline, split_references
+import upload_pipeline
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -16,24 +26,65 @@ logger = logging.getLogger(__name__)
 
 # Конфигурация API Yes Ai
 API_KEY = "yes-b091ffe8d0f341ba9b4dbf18092c0c919a16a3e117d2c9b311dbd24fc122"
-API_URL_GEN_IMAGE = "https://api.yesai.su/v2/google/nanobanana/generations"
-API_URL_QUERY_IMAGE = "https://api.yesai.su/v2/google/nanobanana/generations/"
+API_URL_GEN_IMAGE = os.environ.get("YESAI_API_URL", "https://api.yesai.su/v2/google/nanobanana/generations")
+API_URL_QUERY_IMAGE = f"{API_URL_GEN_IMAGE}/"
+
+# Параметры генерации
+GENERATION_PARAMS = {
+    "version": "v.2",
+    "style": "0",
+    "dimensions": "9:16"
+}
+
+# Опрос статуса задачи
+POLL_MAX_ATTEMPTS = int(os.environ.get("POLL_MAX_ATTEMPTS", "30"))
+POLL_WAIT_TIME = float(os.environ.get("POLL_WAIT_TIME", "5"))
 
 # Конфигурация Freeimage.host
 FREEIMAGE_API_KEY = "6d207e02198a847aa98d0a2a901485a5"
-FREEIMAGE_API_URL = "https://freeimage.host/api/1/upload"
+FREEIMAGE_API_URL = os.environ.get("FREEIMAGE_API_URL", "https://freeimage.host/api/1/upload")
 
 # Создаем папку для сохранения изображений
 IMAGES_FOLDER = "generated_images"
 os.makedirs(IMAGES_FOLDER, exist_ok=True)
 
+# Токен администратора: панель профилирования доступна по адресу ?admin=<токен>
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Ключ подписи ID клиента в адресе страницы (?cid=<id>.<подпись>). Одинаковый на всех репликах;
+# если не задан, используется случайный ключ из общего хранилища
+CUSTOMER_ID_SECRET = os.environ.get("CUSTOMER_ID_SECRET", "")
+
+# Незавершенную задачу другой реплики продолжаем ждать, если она не старше этого времени (сек)
+TASK_RESUME_WINDOW = 10 * 60
+
+# Количество записей на странице галереи истории
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "6"))
+
+@st.cache_resource
+def get_shared_state() -> SharedState:
+    """Общее состояние реплик (одно на процесс)"""
+    return SharedState(create_backend(SHARED_STATE_URL))
+
+@st.cache_resource
+def get_single_flight() -> SingleFlight:
+    """Объединение одинаковых одновременных генераций (одно на процесс)"""
+    return SingleFlight()
+
+@st.cache_resource
+def get_history() -> GenerationHistory:
+    """Индекс истории генераций (один на процесс): в том же хранилище, что и общее состояние"""
+    return create_history(get_shared_state().backend, HISTORY_DB_PATH)
+
 class FreeImageUploader:
     """Класс для загрузки изображений на Freeimage.host"""
     
     def __init__(self):
         self.api_key = FREEIMAGE_API_KEY
         self.api_url = FREEIMAGE_API_URL
+        self.http = resilience.get_client()
     
+    @profiling.profiled()
     def upload_image(self, image_bytes: bytes, filename: str = None) -> Optional[str]:
         """
         Загружает изображение на Freeimage.host и возвращает прямую ссылку
@@ -55,7 +106,8 @@ class FreeImageUploader:
             
             logger.info(f"Отправка изображения на Freeimage.host...")
             
-            response = requests.post(self.api_url, data=data, timeout=30)
+            # POST загрузки не идемпотентен: при сбое не повторяем, чтобы не плодить копии
+            response = self.http.request("freeimage.upload", "POST", self.api_url, data=data)
             
             if response.status_code == 200:
                 result = response.json()
@@ -72,9 +124,12 @@ class FreeImageUploader:
                     return None
             else:
                 error_text = response.text
-                logger.error(f"Ошибка HTTP при загрузке на Freeimage.host: {response.status}, {error_text}")
+                logger.error(f"Ошибка HTTP при загрузке на Freeimage.host: {response.status_code}, {error_text}")
                 return None
                 
+        except resilience.CircuitOpenError as e:
+            logger.error(str(e))
+            return None
         except requests.exceptions.Timeout:
             logger.error("Таймаут при загрузке на Freeimage.host")
             return None
@@ -85,10 +140,14 @@ class FreeImageUploader:
             logger.error(f"Неожиданная ошибка при загрузке на Freeimage.host: {e}")
             return None
     
-    def verify_image_url(self, url: str) -> bool:
-        """Проверяет доступность URL изображения"""
+    def verify_image_url(self, url: str) -> Optional[bool]:
+        """
+        Проверяет доступность URL изображения.
+        Возвращает None, если проверка пропущена (сервис проверки отключен): ссылка не подтверждена,
+        но и не отвергнута - ее проверит сам сервис генерации, а подтвердить можно позже.
+        """
         try:
-            response = requests.head(url, timeout=5, allow_redirects=True)
+            response = self.http.request("freeimage.verify", "HEAD", url, allow_redirects=True)
             if response.status_code == 200:
                 content_type = response.headers.get('Content-Type', '')
                 if content_type.startswith('image/'):
@@ -97,16 +156,21 @@ class FreeImageUploader:
                 else:
                     logger.warning(f"URL {url} не является изображением: {content_type}")
             else:
-                logger.warning(f"URL {url} недоступен: {response.status}")
+                logger.warning(f"URL {url} недоступен: {response.status_code}")
+        except resilience.CircuitOpenError as e:
+            # Проверка только предварительная: без нее ссылку проверит сам сервис генерации
+            logger.warning(f"Проверка URL {url} пропущена: {e}")
+            return None
         except Exception as e:
             logger.warning(f"Ошибка при проверке URL {url}: {e}")
         return False
     
+    @profiling.profiled()
     def verify_image_urls(self, urls: List[str]) -> List[str]:
-        """Проверяет доступность нескольких URL изображений"""
+        """Проверяет доступность нескольких URL изображений (непроверенные не отбрасываются)"""
         valid_urls = []
         for url in urls:
-            if self.verify_image_url(url):
+            if self.verify_image_url(url) is not False:
                 valid_urls.append(url)
         return valid_urls
 
@@ -120,7 +184,14 @@ class ImageGenerator:
             "Authorization": f"Bearer {API_KEY}",
         }
         self.image_uploader = FreeImageUploader()
+        self.http = resilience.get_client()
+        self.url_transport = UrlTransport(
+            self.image_uploader,
+            lambda ref: upload_reference(ref["bytes"], ref["name"], ref["content_hash"])
+        )
+        self.inline_transport = InlineTransport(self.process_image)
     
+    @profiling.profiled()
     def process_image(self, image_bytes: bytes) -> Optional[dict]:
         """Обрабатывает изображение для отправки в API"""
         try:
@@ -155,29 +226,29 @@ class ImageGenerator:
         """Загружает изображение на Freeimage.host"""
         return self.image_uploader.upload_image(image_bytes, filename)
     
+    @profiling.profiled()
     def generate_image(self, prompt: str, customer_id: str) -> dict:
         """Генерация изображения по промпту"""
         data = {
-            "version": "v.2",
+            **GENERATION_PARAMS,
             "prompt": prompt,
-            "style": "0",
-            "dimensions": "9:16",
             "customer_id": customer_id
         }
         
         logger.info(f"Генерация изображения для customer_id: {customer_id}, prompt: {prompt[:50]}...")
         
         try:
-            response = requests.post(
+            response = self.http.request(
+                "yesai.submit",
+                "POST",
                 API_URL_GEN_IMAGE,
                 headers=self.headers,
-                json=data,
-                timeout=60
+                json=data
             )
             
             if response.status_code != 200:
                 error_text = response.text
-                logger.error(f"HTTP Error: {response.status}, Response: {error_text}")
+                logger.error(f"HTTP Error: {response.status_code}, Response: {error_text}")
                 
                 if "CUSTOMER_ID_IS_EMPTY" in error_text:
                     return {"error": "CUSTOMER_ID_IS_EMPTY", "message": "Не указан ID клиента"}
@@ -188,12 +259,15 @@ class ImageGenerator:
                 elif "PROMPT_NSFW_WORDS" in error_text:
                     return {"error": "PROMPT_NSFW_WORDS", "message": "Обнаружены запрещенные слова"}
                 
-                return {"error": f"HTTP {response.status}", "message": error_text}
+                return {"error": f"HTTP {response.status_code}", "message": error_text}
             
             result = response.json()
             logger.info(f"Успешный ответ от API: {result}")
             return result
             
+        except resilience.CircuitOpenError as e:
+            logger.error(str(e))
+            return {"error": "circuit_open", "message": str(e)}
         except requests.exceptions.Timeout:
             logger.error("Таймаут при генерации изображения")
             return {"error": "timeout", "message": "Превышено время ожидания"}
@@ -204,34 +278,50 @@ class ImageGenerator:
             logger.error(f"Неожиданная ошибка: {e}")
             return {"error": "unexpected_error", "message": str(e)}
     
-    def generate_multi_image(self, prompt: str, references_urls: List[str], customer_id: str) -> dict:
+    @profiling.profiled()
+    def encode_references(self, references: List[dict]) -> List[str]:
+        """
+        Значения references_urls для запроса: небольшие изображения встраиваются как data URI
+        (если сервис их принимает), остальные передаются проверенными ссылками на Freeimage.host
+        """
+        inline, by_url = split_references(references)
+        values = {}
+        for transport, group in ((self.inline_transport, inline), (self.url_transport, by_url)):
+            if group:
+                logger.info(f"Референсов с передачей {transport.name}: {len(group)}")
+                values.update(zip(map(id, group), transport.encode(group)))
+        
+        # Сохраняем исходный порядок референсов
+        return [values[id(ref)] for ref in references if values[id(ref)]]
+    
+    @profiling.profiled()
+    def generate_multi_image(self, prompt: str, references: List[dict], customer_id: str) -> dict:
         """
         Генерация изображения с несколькими референсами
         Поддерживается до 10 изображений
         """
         
+        # Дубликаты изображений передаем один раз
+        references = get_references(references)
+        
         # Ограничиваем количество референсов (максимум 10)
-        if len(references_urls) > 10:
-            logger.warning(f"Слишком много референсов: {len(references_urls)}, обрезаем до 10")
-            references_urls = references_urls[:10]
+        if len(references) > 10:
+            logger.warning(f"Слишком много референсов: {len(references)}, обрезаем до 10")
+            references = references[:10]
         
-        # Проверяем доступность URL
-        logger.info(f"Проверка {len(references_urls)} URL изображений...")
-        valid_urls = self.image_uploader.verify_image_urls(references_urls)
+        valid_urls = self.encode_references(references)
         
         if not valid_urls:
-            logger.error("Нет доступных URL изображений")
+            logger.error("Нет доступных изображений")
             return {"error": "no_valid_images", "message": "Ни одно из изображений недоступно"}
         
-        if len(valid_urls) < len(references_urls):
-            logger.warning(f"Доступно только {len(valid_urls)} из {len(references_urls)} изображений")
+        if len(valid_urls) < len(references):
+            logger.warning(f"Доступно только {len(valid_urls)} из {len(references)} изображений")
         
         # Формируем запрос
         data = {
-            "version": "v.2",
+            **GENERATION_PARAMS,
             "prompt": prompt,
-            "style": "0",
-            "dimensions": "9:16",
             "customer_id": customer_id,
             "references_urls": valid_urls
         }
@@ -239,16 +329,17 @@ class ImageGenerator:
         logger.info(f"Multi-image генерация для customer_id: {customer_id}, референсов: {len(valid_urls)}")
         
         try:
-            response = requests.post(
+            response = self.http.request(
+                "yesai.submit",
+                "POST",
                 API_URL_GEN_IMAGE,
                 headers=self.headers,
-                json=data,
-                timeout=60
+                json=data
             )
             
             if response.status_code != 200:
                 error_text = response.text
-                logger.error(f"HTTP Error: {response.status}, Response: {error_text}")
+                logger.error(f"HTTP Error: {response.status_code}, Response: {error_text}")
                 
                 if "CUSTOMER_ID_IS_EMPTY" in error_text:
                     return {"error": "CUSTOMER_ID_IS_EMPTY", "message": "Не указан ID клиента"}
@@ -257,12 +348,15 @@ class ImageGenerator:
                 elif "REFERENCES_URLS_IS_EMPTY" in error_text:
                     return {"error": "REFERENCES_URLS_IS_EMPTY", "message": "Не указаны референсы"}
                 
-                return {"error": f"HTTP {response.status}", "message": error_text}
+                return {"error": f"HTTP {response.status_code}", "message": error_text}
             
             result = response.json()
             logger.info(f"Успешный ответ multi-image API: {result}")
             return result
             
+        except resilience.CircuitOpenError as e:
+            logger.error(str(e))
+            return {"error": "circuit_open", "message": str(e)}
         except requests.exceptions.Timeout:
             logger.error("Таймаут при multi-image генерации")
             return {"error": "timeout", "message": "Превышено время ожидания"}
@@ -273,20 +367,37 @@ class ImageGenerator:
             logger.error(f"Неожиданная ошибка: {e}")
             return {"error": "unexpected_error", "message": str(e)}
     
-    def get_task_result(self, task_id: str, max_attempts: int = 30, wait_time: int = 5) -> Optional[dict]:
+    @profiling.profiled()
+    def get_task_result(self, task_id: str, max_attempts: int = 30, wait_time: float = 5) -> Optional[dict]:
         """Получает результат задачи по task_id"""
         try:
             url = f"{API_URL_QUERY_IMAGE}{task_id}"
+            # Пауза перед опросом; после неудачных опросов подряд растет с джиттером
+            delay = wait_time
+            failures = 0
             
             for attempt in range(max_attempts):
-                time.sleep(wait_time)
+                time.sleep(delay)
                 
-                response = requests.get(url, headers=self.headers, timeout=30)
+                try:
+                    response = self.http.request("yesai.poll", "GET", url, headers=self.headers)
+                except requests.exceptions.RequestException as e:
+                    failures += 1
+                    delay = max(wait_time + resilience.jittered_backoff(failures, base=wait_time),
+                                getattr(e, "retry_in", 0))
+                    logger.warning(f"Попытка {attempt + 1}: {e}, следующий опрос через {delay:.1f} с")
+                    continue
                 
                 if response.status_code != 200:
-                    logger.warning(f"Попытка {attempt + 1}: статус {response.status_code}")
+                    failures += 1
+                    delay = wait_time + resilience.jittered_backoff(failures, base=wait_time)
+                    logger.warning(f"Попытка {attempt + 1}: статус {response.status_code}, "
+                                   f"следующий опрос через {delay:.1f} с")
                     continue
                 
+                failures = 0
+                delay = wait_time
+                
                 result = response.json()
                 logger.info(f"Полный ответ API: {json.dumps(result, indent=2)}")
                 
@@ -332,13 +443,14 @@ class ImageGenerator:
                 "error": str(e)
             }
     
+    @profiling.profiled()
     def download_and_save_image(self, image_url: str) -> Optional[str]:
         """Скачивает изображение по URL и сохраняет локально"""
         try:
             logger.info(f"Скачивание изображения с URL: {image_url}")
             
             # Скачиваем изображение
-            response = requests.get(image_url, timeout=30)
+            response = self.http.request("result.download", "GET", image_url)
             
             if response.status_code != 200:
                 logger.error(f"Не удалось скачать изображение: {response.status_code}")
@@ -377,24 +489,24 @@ class ImageGenerator:
             logger.error(f"Ошибка при скачивании изображения: {e}")
             return None
 
+# Тексты тумблеров, добавляемые к промпту
+TOGGLE_TEXTS = {
+    'price_tags': "проанализируй картинку, это стеллаж с товарами, посмотри где не хватает ценников под товаром, помести туда ценник, исходя из соседних ценников",
+    'random_angle': "поменяй случайно ракурс фотографии, учитывай что эту фотографию делает человек и ракурс не может быть слишком высоким или слишком низким, так же учитывай что товары и ценники должны быть хорошо видны",
+    'messy_shelf': "проанализируй картинку, это стеллаж с товарами, представь что в течение дня покупатели взаимодействовали с этой полкой, случайным образом убери часть товаров",
+    'professional_arrangement': "проанализируй картинку, это стеллаж с товарами, представь что пришел мерчендайзер и выставил все товары, которых не хватало, добавил ценники, которых не хватало",
+    'auto_fix': "проанализируй картинку, это стеллаж с товарами, сделай профессиональную выкладку товаров на полках"
+}
+
 def build_prompt(base_prompt: str, toggles: dict) -> str:
     """
     Строит финальный промпт на основе базового промпта и активных тумблеров
     """
-    # Обновленные тексты промптов
-    toggle_texts = {
-        'price_tags': "проанализируй картинку, это стеллаж с товарами, посмотри где не хватает ценников под товаром, помести туда ценник, исходя из соседних ценников",
-        'random_angle': "поменяй случайно ракурс фотографии, учитывай что эту фотографию делает человек и ракурс не может быть слишком высоким или слишком низким, так же учитывай что товары и ценники должны быть хорошо видны",
-        'messy_shelf': "проанализируй картинку, это стеллаж с товарами, представь что в течение дня покупатели взаимодействовали с этой полкой, случайным образом убери часть товаров",
-        'professional_arrangement': "проанализируй картинку, это стеллаж с товарами, представь что пришел мерчендайзер и выставил все товары, которых не хватало, добавил ценники, которых не хватало",
-        'auto_fix': "проанализируй картинку, это стеллаж с товарами, сделай профессиональную выкладку товаров на полках"
-    }
-    
     # Собираем активные тексты
     active_texts = []
     for toggle_id, is_active in toggles.items():
-        if is_active and toggle_id in toggle_texts:
-            active_texts.append(toggle_texts[toggle_id])
+        if is_active and toggle_id in TOGGLE_TEXTS:
+            active_texts.append(TOGGLE_TEXTS[toggle_id])
     
     # Если нет активных тумблеров, возвращаем базовый промпт
     if not active_texts:
@@ -407,31 +519,107 @@ def build_prompt(base_prompt: str, toggles: dict) -> str:
     # Иначе объединяем базовый промпт с текстами тумблеров
     return f"{base_prompt.strip()}. {' '.join(active_texts)}"
 
+def upload_reference(bytes_data: bytes, name: str, content_hash: str, index: int = 0,
+                     shared_state: Optional[SharedState] = None) -> Optional[str]:
+    """
+    Возвращает URL референса на Freeimage.host. Файл с тем же содержимым мог уже
+    загрузить другой пользователь или другая реплика. Почти-дубликаты между сессиями
+    не ищем: похожие снимки (например, одна полка до и после) дают близкие pHash,
+    и пользователь получил бы чужое изображение.
+    Из фоновых потоков shared_state передается явно: кэшированные ресурсы Streamlit
+    доступны только в потоке скрипта.
+    """
+    shared_state = shared_state or get_shared_state()
+    shared_upload = shared_state.get_upload(content_hash)
+    if shared_upload:
+        logger.info(f"{name} найден в общем кэше: {shared_upload['url']}")
+        return shared_upload["url"]
+    
+    # Загружаем на Freeimage.host
+    image_url = FreeImageUploader().upload_image(bytes_data, f"image_{int(time.time())}_{index}.jpg")
+    if image_url:
+        shared_state.put_upload(content_hash, image_url, name)
+    return image_url
+
+def upload_and_verify(bytes_data: bytes, name: str, content_hash: str,
+                      index: int, shared_state: SharedState) -> Tuple[Optional[str], Optional[bool]]:
+    """
+    Загружает референс и проверяет ссылку (выполняется в фоне): возвращает (url, verified),
+    verified - результат verify_image_url (None, если проверка пропущена)
+    """
+    url = upload_reference(bytes_data, name, content_hash, index, shared_state)
+    if not url:
+        return None, False
+    return url, FreeImageUploader().verify_image_url(url)
+
+def cancel_removed_uploads(uploaded_files):
+    """Отменяет фоновые загрузки файлов, которые пользователь убрал из выбора"""
+    cache = st.session_state.uploaded_files_cache
+    selected = {f"{f.name}_{f.size}" for f in uploaded_files or []}
+    # Дубликат использует загрузку оригинала - ее не отменяем, пока дубликат выбран
+    in_use = {id(cache[key].get("upload")) for key in selected if key in cache}
+    removed = [
+        img for key, img in cache.items()
+        if key not in selected and id(img.get("upload")) not in in_use
+    ]
+    # Отмененные файлы убираем из кэша: при повторном выборе загрузка начнется заново
+    for img in upload_pipeline.cancel(removed):
+        cache.pop(img["file_key"], None)
+
 def process_uploaded_files(uploaded_files):
-    """Обрабатывает загруженные файлы и возвращает список изображений"""
+    """
+    Обрабатывает загруженные файлы и возвращает список изображений.
+    Загрузка на Freeimage.host и проверка ссылок запускаются в фоне и не блокируют интерфейс.
+    Почти-дубликаты (пересохраненные, уменьшенные, пережатые копии) не загружаются
+    повторно: они используют загрузку оригинала и не занимают отдельный слот референса.
+    """
     if not uploaded_files:
         return []
     
-    # Ограничиваем количество файлов
-    if len(uploaded_files) > 10:
-        st.warning("Можно загрузить не более 10 изображений. Первые 10 будут использованы.")
-        uploaded_files = uploaded_files[:10]
+    if 'uploaded_files_cache' not in st.session_state:
+        st.session_state.uploaded_files_cache = {}
     
     processed_images = []
+    unique_refs = set()
+    limit_warned = False
     progress_bar = st.progress(0)
     status_text = st.empty()
     
+    # Ранее загруженные изображения, с которыми сравниваем новые
+    known_images = [
+        img for img in st.session_state.uploaded_files_cache.values()
+        if img.get("phash") and not img.get("duplicate_of")
+    ]
+    
+    # Перцептивные хэши и почти-дубликаты новых файлов ищем одной пачкой:
+    # и среди ранее загруженных изображений, и среди более ранних файлов этой пачки
+    new_files = [
+        f for f in uploaded_files
+        if f"{f.name}_{f.size}" not in st.session_state.uploaded_files_cache and f.size <= 32 * 1024 * 1024
+    ]
+    new_keys = [f"{f.name}_{f.size}" for f in new_files]
+    new_hashes = perceptual_hashes([f.getvalue() for f in new_files])
+    matches = find_duplicates(new_hashes, [img["phash"] for img in known_images])
+    batch_index = {}
+    for j, key in enumerate(new_keys):
+        batch_index.setdefault(key, j)
+    # Оригинал каждого обработанного файла пачки (для оригинала - он сам)
+    batch_originals = {}
+    
     for i, uploaded_file in enumerate(uploaded_files):
         try:
             # Проверяем, не загружали ли мы уже этот файл
             file_key = f"{uploaded_file.name}_{uploaded_file.size}"
             
             # Если файл уже есть в session_state, пропускаем загрузку
-            if 'uploaded_files_cache' not in st.session_state:
-                st.session_state.uploaded_files_cache = {}
-            
             if file_key in st.session_state.uploaded_files_cache:
                 cached_image = st.session_state.uploaded_files_cache[file_key]
+                if cached_image["ref_key"] not in unique_refs and len(unique_refs) >= 10:
+                    if not limit_warned:
+                        st.warning("Можно загрузить не более 10 изображений. Первые 10 будут использованы.")
+                        limit_warned = True
+                    continue
+                unique_refs.add(cached_image["ref_key"])
                 processed_images.append(cached_image)
                 status_text.text(f"✅ {uploaded_file.name} (из кэша)")
                 progress_bar.progress((i + 1) / len(uploaded_files))
@@ -447,37 +635,77 @@ def process_uploaded_files(uploaded_files):
                 st.warning(f"❌ {uploaded_file.name} превышает 32 МБ и не будет загружен")
                 continue
             
-            # Загружаем на Freeimage.host
-            generator = ImageGenerator()
-            status_text.text(f"📤 Загрузка {uploaded_file.name} на Freeimage.host...")
-            image_url = generator.upload_to_freeimage(
-                bytes_data, 
-                f"image_{int(time.time())}_{i}.jpg"
-            )
+            # Почти-дубликат среди ранее загруженных изображений или более раннего файла пачки
+            j = batch_index[file_key]
+            phash = new_hashes[j]
+            match = matches[j]
+            original = None
+            if match is not None and match < len(known_images):
+                original = known_images[match]
+            elif match is not None:
+                # Совпавший файл мог быть пропущен (лимит, ошибка) - тогда этот файл уникален
+                original = batch_originals.get(new_keys[match - len(known_images)])
             
-            if image_url:
-                # Создаем превью
-                image = Image.open(io.BytesIO(bytes_data))
-                image.thumbnail((200, 200))
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='JPEG')
-                thumbnail = img_byte_arr.getvalue()
-                
-                image_info = {
-                    "name": uploaded_file.name,
-                    "thumbnail": thumbnail,
-                    "url": image_url,
-                    "bytes": bytes_data,
-                    "file_key": file_key
-                }
-                
-                # Сохраняем в кэш
-                st.session_state.uploaded_files_cache[file_key] = image_info
-                processed_images.append(image_info)
+            content_hash = hashlib.sha256(bytes_data).hexdigest()
+            
+            if original:
+                image_url = original["url"]
+                upload = original.get("upload")
+                ref_key = original["ref_key"]
+                logger.info(f"{uploaded_file.name} - дубликат {original['name']}, используем его референс")
+            else:
+                if len(unique_refs) >= 10:
+                    if not limit_warned:
+                        st.warning("Можно загрузить не более 10 изображений. Первые 10 будут использованы.")
+                        limit_warned = True
+                    continue
                 
-                status_text.text(f"✅ {uploaded_file.name} загружен")
+                ref_key = content_hash
+                image_url = None
+                upload = None
+                # Изображение, которое может быть встроено в запрос генерации, пока не загружаем:
+                # какие из них поместятся в лимит запроса, решит start_deferred_uploads.
+                # Остальные загружаются в фоне, пока пользователь пишет промпт;
+                # генерация присоединится к незавершенной загрузке
+                if not can_inline(len(bytes_data)):
+                    upload = upload_pipeline.get_pipeline().submit(
+                        upload_and_verify, bytes_data, uploaded_file.name, content_hash, i,
+                        get_shared_state()
+                    )
+            
+            # Создаем превью
+            image = Image.open(io.BytesIO(bytes_data))
+            image.thumbnail((200, 200))
+            img_byte_arr = io.BytesIO()
+            image.save(img_byte_arr, format='JPEG')
+            thumbnail = img_byte_arr.getvalue()
+            
+            image_info = {
+                "name": uploaded_file.name,
+                "thumbnail": thumbnail,
+                "url": image_url,
+                "upload": upload,
+                "verified": False,
+                "deferred": not original and upload is None,
+                "bytes": bytes_data,
+                "file_key": file_key,
+                "content_hash": content_hash,
+                "ref_key": ref_key,
+                "phash": phash,
+                "duplicate_of": original["name"] if original else None
+            }
+            
+            # Сохраняем в кэш
+            st.session_state.uploaded_files_cache[file_key] = image_info
+            processed_images.append(image_info)
+            unique_refs.add(ref_key)
+            
+            batch_originals[file_key] = original or image_info
+            
+            if original:
+                status_text.text(f"♻️ {uploaded_file.name} - дубликат {original['name']}")
             else:
-                st.warning(f"❌ Не удалось загрузить {uploaded_file.name}")
+                status_text.text(f"✅ {uploaded_file.name} добавлен")
             
             progress_bar.progress((i + 1) / len(uploaded_files))
             
@@ -487,8 +715,364 @@ def process_uploaded_files(uploaded_files):
     progress_bar.empty()
     status_text.empty()
     
+    start_deferred_uploads(processed_images)
+    
     return processed_images
 
+def start_deferred_uploads(images: List[dict]):
+    """
+    Запускает фоновую загрузку отложенных изображений, которые не помещаются
+    в общий лимит встроенных референсов запроса (INLINE_MAX_TOTAL_KB)
+    """
+    _, by_url = split_references(get_references(images))
+    overflow = {ref["ref_key"]: ref for ref in by_url if ref.get("deferred")}
+    if not overflow:
+        return
+    
+    shared_state = get_shared_state()
+    uploads = {
+        ref_key: upload_pipeline.get_pipeline().submit(
+            upload_and_verify, ref["bytes"], ref["name"], ref["content_hash"], i, shared_state
+        )
+        for i, (ref_key, ref) in enumerate(overflow.items())
+    }
+    # Дубликаты используют загрузку оригинала
+    for img in images:
+        if img["ref_key"] in uploads and img.get("upload") is None and not img.get("url"):
+            img.update(upload=uploads[img["ref_key"]], deferred=False)
+    logger.info(f"Не помещаются в лимит встроенных референсов, загружаются: {len(uploads)}")
+
+def get_references(images: List[dict]) -> List[dict]:
+    """
+    Референсы без повторов: дубликат представлен оригиналом,
+    а изображения с одной ссылкой на Freeimage.host передаются один раз
+    """
+    references = []
+    seen = set()
+    for img in images:
+        keys = {img["ref_key"], img.get("url")} - {None}
+        if keys & seen:
+            continue
+        seen |= keys
+        references.append(img)
+    return references
+
+def customer_id_signature(customer_id: str) -> Optional[str]:
+    """
+    Подпись ID клиента. По адресу страницы открывается вся история клиента,
+    поэтому короткий ID без подписи нельзя принимать - его легко подобрать
+    """
+    if CUSTOMER_ID_SECRET:
+        secret = CUSTOMER_ID_SECRET.encode("utf-8")
+    else:
+        secret = get_shared_state().get_secret("customer_id")
+    if not secret:
+        return None
+    return hmac.new(secret, customer_id.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+def customer_id_from_query_params() -> Optional[str]:
+    """ID клиента из адреса страницы, если его подпись верна"""
+    customer_id, _, signature = st.experimental_get_query_params().get("cid", [""])[0].partition(".")
+    if not customer_id.isalnum():
+        return None
+    expected = customer_id_signature(customer_id)
+    # compare_digest не принимает строки с не-ASCII символами
+    if not expected or not hmac.compare_digest(signature.encode("utf-8"), expected.encode("utf-8")):
+        logger.warning(f"Отклонен ID клиента с неверной подписью: {customer_id}")
+        return None
+    return customer_id
+
+def set_customer_query_param(customer_id: str):
+    """Сохраняет подписанный ID клиента в адресе страницы, не трогая остальные параметры"""
+    params = st.experimental_get_query_params()
+    signature = customer_id_signature(customer_id)
+    if signature:
+        params["cid"] = f"{customer_id}.{signature}"
+    else:
+        # Без ключа подписи ID в адрес не попадает: работа продолжается только в этой сессии
+        params.pop("cid", None)
+    st.experimental_set_query_params(**params)
+
+def is_admin() -> bool:
+    """Проверяет токен администратора из адреса страницы"""
+    if not ADMIN_TOKEN:
+        return False
+    token = st.experimental_get_query_params().get("admin", [""])[0]
+    # compare_digest не принимает строки с не-ASCII символами
+    return hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+def render_services_status():
+    """Предупреждения об отключенных внешних сервисах"""
+    for endpoint in resilience.get_client().status().values():
+        if endpoint["state"] == "open":
+            st.warning(f"⚠️ {endpoint['label']}: сервис не отвечает, "
+                       f"повторная попытка через {int(endpoint['retry_in']) + 1} с")
+        elif endpoint["state"] == "half_open":
+            st.warning(f"⚠️ {endpoint['label']}: проверяем восстановление сервиса")
+
+def open_history_entry(entry: dict):
+    """Показывает результат из истории в основной области"""
+    local_path = get_shared_state().load_result_file(entry["task_id"], IMAGES_FOLDER)
+    if not local_path and os.path.exists(entry["filepath"]):
+        local_path = entry["filepath"]
+    
+    if not local_path:
+        st.warning("⚠️ Файл этого результата больше недоступен")
+        return
+    
+    st.session_state.task_id = entry["task_id"]
+    st.session_state.last_result_path = local_path
+    st.session_state.last_result_url = entry["image_url"]
+    st.session_state.generation_completed = True
+
+def render_history_gallery():
+    """Галерея прошлых генераций клиента с постраничным листанием"""
+    history = get_history()
+    customer_id = st.session_state.customer_id
+    
+    # Курсоры начала просмотренных страниц; сбрасываются при смене клиента
+    if st.session_state.get("history_customer_id") != customer_id:
+        st.session_state.history_customer_id = customer_id
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    
+    total = history.count(customer_id)
+    with st.expander(f"🖼️ История генераций ({total})"):
+        if not total:
+            st.caption("Здесь появятся ваши генерации")
+            return
+        
+        entries, next_cursor = history.page(customer_id, HISTORY_PAGE_SIZE, cursors[-1])
+        
+        for entry in entries:
+            thumbnail = history.load_thumbnail(entry)
+            if thumbnail:
+                st.image(thumbnail, use_column_width=True)
+            created = time.strftime("%d.%m.%Y %H:%M", time.localtime(entry["created_at"]))
+            prompt = entry["prompt"][:60] + ("..." if len(entry["prompt"]) > 60 else "")
+            st.caption(f"{created} · {prompt or 'без промпта'}")
+            if st.button("Открыть", key=f"history_open_{entry['id']}", use_container_width=True):
+                open_history_entry(entry)
+        
+        pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        col_prev, col_page, col_next = st.columns([1, 2, 1])
+        # Курсор меняется в on_click до перезапуска скрипта - страница отрисуется сразу
+        with col_prev:
+            st.button("◀", key="history_prev", disabled=len(cursors) == 1, on_click=cursors.pop)
+        with col_page:
+            st.caption(f"Страница {len(cursors)} из {pages}")
+        with col_next:
+            st.button("▶", key="history_next", disabled=next_cursor is None,
+                      on_click=cursors.append, args=(next_cursor,))
+
+def render_profiling_panel():
+    """Панель включения профилирования на работающем экземпляре"""
+    with st.expander("🛠️ Профилирование"):
+        prof_status = profiling.status()
+        
+        if prof_status["enabled"]:
+            if prof_status["remaining_seconds"] is None:
+                st.success("Профилирование включено бессрочно")
+            else:
+                st.success(f"Профилирование включено, осталось {prof_status['remaining_seconds'] // 60} мин")
+            st.caption(
+                f"Выборка: {prof_status['sample_rate']:.0%}, "
+                f"аллокации: {'да' if prof_status['track_allocations'] else 'нет'}"
+            )
+            if st.button("⏹️ Выключить профилирование", use_container_width=True):
+                profiling.disable()
+                st.rerun()
+        else:
+            minutes = st.number_input("Длительность, мин", min_value=1, max_value=60, value=5)
+            sample_rate = st.slider("Доля профилируемых операций", 0.05, 1.0, 1.0, step=0.05)
+            track_allocations = st.checkbox("Отслеживать аллокации (tracemalloc)")
+            if st.button("▶️ Включить профилирование", use_container_width=True):
+                profiling.enable(minutes, track_allocations, sample_rate)
+                st.rerun()
+        
+        st.caption(f"📁 {prof_status['directory']}")
+
+def restore_customer_task():
+    """
+    Восстанавливает последнюю задачу клиента из общего хранилища.
+    Задача могла быть запущена на другой реплике до переключения балансировщиком.
+    """
+    shared_state = get_shared_state()
+    task = shared_state.get_customer_task(st.session_state.customer_id)
+    
+    if not task:
+        return
+    
+    task_id = task["task_id"]
+    
+    if task["status"] == "success":
+        local_path = shared_state.load_result_file(task_id, IMAGES_FOLDER)
+        if local_path:
+            st.session_state.task_id = task_id
+            st.session_state.last_result_path = local_path
+            st.session_state.last_result_url = task.get("image_url")
+            st.session_state.generation_completed = True
+            logger.info(f"Восстановлен результат задачи {task_id} для клиента {st.session_state.customer_id}")
+    
+    elif task["status"] == "pending" and time.time() - task["updated_at"] < TASK_RESUME_WINDOW:
+        st.session_state.task_id = task_id
+        st.session_state.resume_task_id = task_id
+        logger.info(f"Продолжаем ожидание задачи {task_id} для клиента {st.session_state.customer_id}")
+
+def generation_key(prompt: str, images: List[dict]) -> str:
+    """
+    Ключ одинаковых запросов генерации: нормализованный промпт,
+    содержимое референсов и параметры генерации
+    """
+    normalized_prompt = " ".join(prompt.split()).lower()
+    references = sorted({img["ref_key"] for img in get_references(images)})
+    payload = json.dumps([normalized_prompt, references, GENERATION_PARAMS], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def submit_generation(generator: ImageGenerator, prompt: str, references: List[dict], customer_id: str,
+                      metadata: Optional[dict] = None) -> dict:
+    """
+    Отправляет задачу на генерацию и регистрирует ее в общем хранилище
+    вместе с metadata (тумблеры, хэши референсов) для истории
+    """
+    gen_result = generator.generate_multi_image(prompt, references, customer_id)
+    
+    if not gen_result or "error" in gen_result:
+        error_msg = gen_result.get("message", gen_result.get("error", "Неизвестная ошибка")) if gen_result else "Ошибка подключения"
+        return {"error": f"Ошибка при генерации: {error_msg}"}
+    
+    if 'results' not in gen_result or 'generation_data' not in gen_result['results']:
+        return {"error": f"Ошибка API: {gen_result}"}
+    
+    api_task_id = gen_result['results']['generation_data']['id']
+    
+    # Регистрируем задачу, чтобы ее могла подхватить любая реплика
+    get_shared_state().register_task(api_task_id, customer_id, prompt=prompt, **(metadata or {}))
+    
+    return {"task_id": api_task_id}
+
+def complete_task(generator: ImageGenerator, api_task_id: str) -> dict:
+    """
+    Ожидает результат задачи и скачивает изображение.
+    Итог задачи публикуется в общем хранилище.
+    """
+    shared_state = get_shared_state()
+    timings = {}
+    
+    started = time.time()
+    task_result = generator.get_task_result(api_task_id, max_attempts=POLL_MAX_ATTEMPTS, wait_time=POLL_WAIT_TIME)
+    timings["wait"] = round(time.time() - started, 3)
+    
+    if not task_result:
+        return {"task_id": api_task_id, "error": "Не удалось получить результат генерации"}
+    
+    logger.info(f"Результат задачи: {task_result}")
+    
+    if task_result.get("status") != "success":
+        error_msg = task_result.get("error", "Неизвестная ошибка")
+        shared_state.update_task(api_task_id, status=task_result.get("status"), error=error_msg)
+        return {"task_id": api_task_id, "error": f"Ошибка генерации: {error_msg}"}
+    
+    image_url = task_result.get("image_url")
+    
+    if not image_url:
+        return {"task_id": api_task_id, "error": "Не получен URL изображения"}
+    
+    # Скачиваем и сохраняем изображение локально
+    started = time.time()
+    local_path = generator.download_and_save_image(image_url)
+    timings["download"] = round(time.time() - started, 3)
+    
+    if not local_path:
+        return {"task_id": api_task_id, "image_url": image_url, "error": "Не удалось сохранить изображение локально"}
+    
+    # Публикуем результат для остальных реплик
+    shared_state.put_result(api_task_id, local_path, image_url)
+    shared_state.update_task(api_task_id, status="success", image_url=image_url)
+    
+    return {"task_id": api_task_id, "image_url": image_url, "local_path": local_path, "timings": timings}
+
+def run_generation(generator: ImageGenerator, prompt: str, references: List[dict], customer_id: str,
+                   on_submitted: Optional[Callable[[str], None]] = None, metadata: Optional[dict] = None) -> dict:
+    """Полный цикл генерации: отправка задачи, ожидание и скачивание результата"""
+    started = time.time()
+    submitted = submit_generation(generator, prompt, references, customer_id, metadata)
+    submit_time = round(time.time() - started, 3)
+    
+    if "error" in submitted:
+        return submitted
+    
+    if on_submitted:
+        on_submitted(submitted["task_id"])
+    
+    result = complete_task(generator, submitted["task_id"])
+    if "timings" in result:
+        result["timings"] = {"submit": submit_time, **result["timings"],
+                             "total": round(time.time() - started, 3)}
+    return result
+
+def record_generation(customer_id: str, result: dict, request: Optional[dict] = None):
+    """
+    Записывает успешную генерацию в историю клиента.
+    Параметры запроса берутся из request, а для задач другой реплики - из общего хранилища.
+    """
+    if request is None:
+        request = get_shared_state().get_task(result["task_id"]) or {}
+    
+    get_history().add(
+        customer_id=customer_id,
+        task_id=result["task_id"],
+        prompt=request.get("prompt", ""),
+        toggles=request.get("toggles", {}),
+        reference_hashes=request.get("reference_hashes", []),
+        filepath=result["local_path"],
+        image_url=result.get("image_url"),
+        created_at=request.get("created_at"),
+        durations=result.get("timings")
+    )
+
+def show_task_waiting(status_placeholder, api_task_id: str):
+    with status_placeholder.container():
+        st.info(f"🆔 ID задачи: `{api_task_id}`\n\n⏳ Ожидание результата... Это может занять 30-60 секунд")
+
+def show_generation_result(result: dict, status_placeholder, result_placeholder, shared: bool = False):
+    """Сохраняет итог генерации в session_state и отображает его"""
+    if result.get("task_id"):
+        st.session_state.task_id = result["task_id"]
+    if result.get("image_url"):
+        st.session_state.last_result_url = result["image_url"]
+    
+    if "error" in result:
+        st.error(f"❌ {result['error']}")
+        return
+    
+    local_path = result["local_path"]
+    st.session_state.last_result_path = local_path
+    st.session_state.generation_completed = True
+    
+    # Очищаем статус
+    status_placeholder.empty()
+    
+    # Отображаем результат
+    with result_placeholder.container():
+        st.success("✅ Генерация завершена!")
+        if shared:
+            st.caption("🤝 Такой же запрос одновременно отправил другой пользователь - результат общий")
+        st.image(local_path, caption="Результат", use_column_width=True)
+        
+        # Кнопка для скачивания
+        with open(local_path, "rb") as file:
+            st.download_button(
+                label="📥 Скачать изображение",
+                data=file,
+                file_name=f"generated_{uuid.uuid4()}.jpg",
+                mime="image/jpeg",
+                use_container_width=True
+            )
+        
+        st.caption(f"🆔 ID задачи: {result['task_id']}")
+        st.caption(f"🔗 URL: {result['image_url']}")
+
 def main():
     """Основная функция Streamlit приложения"""
     
@@ -523,7 +1107,13 @@ def main():
         st.session_state.task_id = None
     
     if 'customer_id' not in st.session_state:
-        st.session_state.customer_id = str(uuid.uuid4())[:8]
+        # ID клиента хранится в адресе страницы: при переключении на другую
+        # реплику пользователь продолжает работу со своими задачами
+        customer_id = customer_id_from_query_params()
+        if not customer_id:
+            customer_id = str(uuid.uuid4())[:8]
+            set_customer_query_param(customer_id)
+        st.session_state.customer_id = customer_id
     
     if 'uploaded_files_cache' not in st.session_state:
         st.session_state.uploaded_files_cache = {}
@@ -543,6 +1133,10 @@ def main():
     if 'generation_completed' not in st.session_state:
         st.session_state.generation_completed = False
     
+    if 'resume_task_id' not in st.session_state:
+        st.session_state.resume_task_id = None
+        restore_customer_task()
+    
     # Боковая панель с информацией
     with st.sidebar:
         st.header("ℹ️ Информация")
@@ -565,12 +1159,14 @@ def main():
         
         st.markdown("---")
         st.markdown("**Статус:**")
-        st.info(f"📎 Загружено изображений: {len(st.session_state.uploaded_images)}/10")
+        st.info(f"📎 Загружено изображений: {len(get_references(st.session_state.uploaded_images))}/10")
+        render_services_status()
         
         # Кнопка очистки кэша
         if st.button("🗑️ Очистить кэш изображений", use_container_width=True):
             try:
                 # Очищаем кэш в session_state
+                upload_pipeline.cancel(list(st.session_state.uploaded_files_cache.values()))
                 st.session_state.uploaded_files_cache = {}
                 st.session_state.uploaded_images = []
                 st.session_state.last_result_path = None
@@ -590,7 +1186,15 @@ def main():
         # Кнопка сброса ID клиента
         if st.button("🔄 Новый ID клиента", use_container_width=True):
             st.session_state.customer_id = str(uuid.uuid4())[:8]
+            set_customer_query_param(st.session_state.customer_id)
             st.rerun()
+        
+        st.markdown("---")
+        render_history_gallery()
+        
+        if is_admin():
+            st.markdown("---")
+            render_profiling_panel()
     
     # Основная область
     col1, col2 = st.columns([3, 2])
@@ -607,6 +1211,8 @@ def main():
             disabled=st.session_state.processing
         )
         
+        cancel_removed_uploads(uploaded_files)
+        
         # Обработка загруженных файлов (только если есть новые файлы)
         if uploaded_files and not st.session_state.processing:
             # Проверяем, изменились ли файлы
@@ -621,7 +1227,15 @@ def main():
                 st.session_state.generation_completed = False
                 
                 if st.session_state.uploaded_images:
-                    st.success(f"✅ Успешно загружено {len(st.session_state.uploaded_images)} изображений")
+                    unique_count = len(get_references(st.session_state.uploaded_images))
+                    duplicates_count = len(st.session_state.uploaded_images) - unique_count
+                    st.success(f"✅ Добавлено {unique_count} изображений")
+                    if duplicates_count:
+                        st.info(f"♻️ Найдено дубликатов: {duplicates_count} - они не займут отдельные слоты")
+        
+        # Пока пользователь пишет промпт, заранее открываем соединения с сервисами
+        if st.session_state.uploaded_images and not st.session_state.processing:
+            upload_pipeline.get_pipeline().warm_up([API_URL_GEN_IMAGE, FREEIMAGE_API_URL])
         
         # Отображение загруженных изображений
         if st.session_state.uploaded_images:
@@ -643,10 +1257,20 @@ def main():
                                 caption=f"{img_idx + 1}. {img_data['name'][:10]}...",
                                 use_column_width=True
                             )
-                            st.caption(f"✅ Загружено")
+                            if img_data.get("duplicate_of"):
+                                st.caption(f"♻️ Дубликат: {img_data['duplicate_of'][:10]}")
+                            elif not upload_pipeline.settle(img_data):
+                                st.caption(f"⏳ Загружается...")
+                            elif img_data["url"]:
+                                st.caption(f"✅ Загружено")
+                            elif img_data.get("deferred"):
+                                st.caption(f"✅ Готово")
+                            else:
+                                st.caption(f"⚠️ Загрузится при генерации")
             
             # Кнопка очистки
             if st.button("🗑️ Очистить все изображения", disabled=st.session_state.processing):
+                upload_pipeline.cancel(list(st.session_state.uploaded_files_cache.values()))
                 st.session_state.uploaded_images = []
                 st.session_state.uploaded_files_cache = {}
                 st.session_state.last_result_path = None
@@ -755,118 +1379,94 @@ def main():
             st.session_state.processing = True
             st.session_state.task_id = None
             st.session_state.generation_completed = False
+            st.session_state.resume_task_id = None
             
             # Очищаем предыдущие результаты
             status_placeholder.empty()
             result_placeholder.empty()
             
             try:
-                # Извлекаем URL изображений
-                references_urls = [img["url"] for img in st.session_state.uploaded_images if "url" in img]
+                # Уникальные референсы
+                references = get_references(st.session_state.uploaded_images)
                 
-                if not references_urls:
-                    st.error("❌ Нет доступных URL изображений")
+                if not references:
+                    st.error("❌ Нет доступных изображений")
                     st.session_state.processing = False
                     return
                 
+                # Одинаковые одновременные запросы (промпт, референсы, параметры)
+                # объединяются в одну задачу Yes Ai
+                flight_key = generation_key(final_prompt, st.session_state.uploaded_images)
+                request = {
+                    "toggles": dict(st.session_state.toggle_states),
+                    "reference_hashes": list(dict.fromkeys(
+                        img["content_hash"] for img in st.session_state.uploaded_images if img.get("content_hash")
+                    ))
+                }
+                requested_at = time.time()
+                single_flight = get_single_flight()
+                
                 # Показываем прогресс
                 with status_placeholder.container():
-                    status_text = st.empty()
-                    status_text.info(f"🔄 Отправка запроса в API Yes Ai...")
+                    if single_flight.in_flight(flight_key):
+                        st.info("🤝 Такая же генерация уже выполняется - ожидаем ее результат...")
+                    else:
+                        st.info(f"🔄 Отправка запроса в API Yes Ai...")
                 
-                # Отправляем запрос на генерацию
-                gen_result = st.session_state.generator.generate_multi_image(
-                    final_prompt, 
-                    references_urls, 
-                    st.session_state.customer_id
+                result, shared = single_flight.do(
+                    flight_key,
+                    run_generation,
+                    st.session_state.generator,
+                    final_prompt,
+                    references,
+                    st.session_state.customer_id,
+                    on_submitted=lambda task_id: show_task_waiting(status_placeholder, task_id),
+                    metadata=request
                 )
                 
-                if gen_result and "error" not in gen_result:
-                    if 'results' in gen_result and 'generation_data' in gen_result['results']:
-                        api_task_id = gen_result['results']['generation_data']['id']
-                        st.session_state.task_id = api_task_id
-                        
-                        with status_placeholder.container():
-                            progress_text = st.empty()
-                            progress_text.info(f"🆔 ID задачи: `{api_task_id}`\n\n⏳ Ожидание результата... Это может занять 30-60 секунд")
-                        
-                        # Получаем результат
-                        task_result = st.session_state.generator.get_task_result(api_task_id, max_attempts=30, wait_time=5)
-                        
-                        if task_result:
-                            logger.info(f"Результат задачи: {task_result}")
-                            
-                            if task_result.get("status") == "success":
-                                image_url = task_result.get("image_url")
-                                
-                                if image_url:
-                                    st.session_state.last_result_url = image_url
-                                    
-                                    # Скачиваем и сохраняем изображение локально
-                                    with status_placeholder.container():
-                                        status_text.info(f"📥 Скачивание изображения...")
-                                    
-                                    local_path = st.session_state.generator.download_and_save_image(image_url)
-                                    
-                                    if local_path:
-                                        st.session_state.last_result_path = local_path
-                                        st.session_state.generation_completed = True
-                                        
-                                        # Очищаем статус
-                                        status_placeholder.empty()
-                                        
-                                        # Отображаем результат
-                                        with result_placeholder.container():
-                                            st.success("✅ Генерация завершена!")
-                                            st.image(local_path, caption="Результат", use_column_width=True)
-                                            
-                                            # Кнопка для скачивания
-                                            with open(local_path, "rb") as file:
-                                                st.download_button(
-                                                    label="📥 Скачать изображение",
-                                                    data=file,
-                                                    file_name=f"generated_{uuid.uuid4()}.jpg",
-                                                    mime="image/jpeg",
-                                                    use_container_width=True
-                                                )
-                                            
-                                            st.caption(f"🆔 ID задачи: {api_task_id}")
-                                            st.caption(f"🔗 URL: {image_url}")
-                                        
-                                        # Сбрасываем флаг processing после успешного завершения
-                                        st.session_state.processing = False
-                                    else:
-                                        st.error("❌ Не удалось сохранить изображение локально")
-                                        st.session_state.processing = False
-                                else:
-                                    st.error("❌ Не получен URL изображения")
-                                    st.session_state.processing = False
-                            else:
-                                error_msg = task_result.get("error", "Неизвестная ошибка")
-                                st.error(f"❌ Ошибка генерации: {error_msg}")
-                                st.session_state.processing = False
-                        else:
-                            st.error("❌ Не удалось получить результат генерации")
-                            st.session_state.processing = False
-                    else:
-                        st.error(f"❌ Ошибка API: {gen_result}")
-                        st.session_state.processing = False
-                else:
-                    error_msg = gen_result.get("message", gen_result.get("error", "Неизвестная ошибка")) if gen_result else "Ошибка подключения"
-                    st.error(f"❌ Ошибка при генерации: {error_msg}")
-                    st.session_state.processing = False
+                if shared and result.get("task_id"):
+                    get_shared_state().link_customer_task(st.session_state.customer_id, result["task_id"])
+                
+                if "error" not in result:
+                    record_generation(
+                        st.session_state.customer_id,
+                        result,
+                        {"prompt": final_prompt, "created_at": requested_at, **request}
+                    )
+                
+                show_generation_result(result, status_placeholder, result_placeholder, shared)
                 
             except Exception as e:
                 st.error(f"❌ Произошла ошибка: {str(e)}")
                 logger.error(f"Ошибка генерации: {e}", exc_info=True)
-                st.session_state.processing = False
             
             finally:
-                # Если generation_completed уже True, processing уже сброшен
-                if not st.session_state.generation_completed:
-                    st.session_state.processing = False
+                st.session_state.processing = False
                 # Не вызываем st.rerun() здесь, чтобы избежать цикла
         
+        # Задача, начатая на другой реплике, еще выполняется - продолжаем ожидание здесь
+        elif st.session_state.resume_task_id and not st.session_state.processing:
+            api_task_id = st.session_state.resume_task_id
+            st.session_state.resume_task_id = None
+            st.session_state.processing = True
+            
+            try:
+                show_task_waiting(status_placeholder, api_task_id)
+                result, shared = get_single_flight().do(
+                    f"task:{api_task_id}",
+                    complete_task,
+                    st.session_state.generator,
+                    api_task_id
+                )
+                if "error" not in result:
+                    record_generation(st.session_state.customer_id, result)
+                show_generation_result(result, status_placeholder, result_placeholder)
+            except Exception as e:
+                st.error(f"❌ Произошла ошибка: {str(e)}")
+                logger.error(f"Ошибка ожидания задачи {api_task_id}: {e}", exc_info=True)
+            finally:
+                st.session_state.processing = False
+        
         # Если генерация завершена и есть результат, показываем его
         if st.session_state.generation_completed and st.session_state.last_result_path:
             if os.path.exists(st.session_state.last_result_path):
@@ -890,4 +1490,5 @@ def main():
                         st.caption(f"🔗 URL: {st.session_state.last_result_url}")
 
 if __name__ == "__main__":
-    main()
+    with profiling.profile("rerun"):
+        main()
@@ -0,0 +1,332 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from shared_state import RedisBackend, SharedStateBackend
+
+logger = logging.getLogger(__name__)
+
+# Индекс истории генераций, если общее состояние хранится в SQLite. Файл в режиме WAL:
+# общий только для реплик на одной машине, на сетевом томе его размещать нельзя.
+# С хранилищем Redis история хранится на том же сервере, а в каталоге файла - только кэш миниатюр
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", "history/history.sqlite3")
+# Размер миниатюр галереи (по длинной стороне)
+THUMBNAIL_SIZE = int(os.environ.get("HISTORY_THUMBNAIL_SIZE", "256"))
+
+# Курсор страницы: (created_at, id) последней записи предыдущей страницы
+Cursor = Tuple[float, int]
+
+_COLUMNS = (
+    "id", "customer_id", "task_id", "prompt", "toggles", "reference_hashes",
+    "created_at", "completed_at", "durations", "filepath", "image_url", "thumbnail"
+)
+_JSON_COLUMNS = ("toggles", "reference_hashes", "durations")
+
+
+class GenerationHistory:
+    """
+    Интерфейс истории генераций: кто, что и с какими референсами генерировал,
+    сколько заняла каждая фаза и где лежит результат.
+    Страницы выбираются по курсору (created_at, id) без OFFSET,
+    поэтому листание не замедляется с ростом числа записей.
+    """
+
+    def __init__(self, thumbnails_dir: str):
+        self.thumbnails_dir = thumbnails_dir
+        os.makedirs(self.thumbnails_dir, exist_ok=True)
+
+    def _thumbnail_path(self, task_id: str) -> str:
+        # Раскладываем по подкаталогам, чтобы в одном каталоге не было сотен тысяч файлов
+        digest = hashlib.sha1(task_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.thumbnails_dir, digest[:2], f"{digest}.jpg")
+
+    def make_thumbnail(self, filepath: str, task_id: str) -> Optional[str]:
+        """Сохраняет миниатюру результата для галереи (одну на задачу)"""
+        thumb_path = self._thumbnail_path(task_id)
+        if os.path.exists(thumb_path):
+            return thumb_path
+
+        try:
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            with Image.open(filepath) as image:
+                image = image.convert("RGB")
+                image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                tmp_path = f"{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                image.save(tmp_path, "JPEG", quality=80)
+            os.replace(tmp_path, thumb_path)
+            return thumb_path
+        except Exception as e:
+            logger.warning(f"Не удалось создать миниатюру для {task_id}: {e}")
+            return None
+
+    def load_thumbnail(self, entry: dict) -> Optional[str]:
+        """Путь к миниатюре записи на этой реплике или None"""
+        if entry["thumbnail"] and os.path.exists(entry["thumbnail"]):
+            return entry["thumbnail"]
+        return None
+
+    def add(self, customer_id: str, task_id: str, prompt: str, toggles: dict,
+            reference_hashes: List[str], filepath: str, image_url: Optional[str],
+            created_at: Optional[float] = None, durations: Optional[dict] = None) -> Optional[int]:
+        """Записывает завершенную генерацию. Повторная запись той же задачи клиента игнорируется"""
+        raise NotImplementedError
+
+    def page(self, customer_id: str, limit: int,
+             after: Optional[Cursor] = None) -> Tuple[List[dict], Optional[Cursor]]:
+        """
+        Страница истории клиента от новых к старым.
+        Возвращает записи и курсор следующей страницы (None, если она последняя).
+        """
+        raise NotImplementedError
+
+    def count(self, customer_id: str) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteHistory(GenerationHistory):
+    """История в SQLite: индекс (customer_id, created_at, id), реплики на одной машине"""
+
+    def __init__(self, path: str = HISTORY_DB_PATH):
+        self.path = path
+        super().__init__(os.path.join(os.path.dirname(os.path.abspath(path)), "thumbnails"))
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " customer_id TEXT NOT NULL,"
+            " task_id TEXT NOT NULL,"
+            " prompt TEXT NOT NULL,"
+            " toggles TEXT NOT NULL,"
+            " reference_hashes TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " completed_at REAL NOT NULL,"
+            " durations TEXT NOT NULL,"
+            " filepath TEXT NOT NULL,"
+            " image_url TEXT,"
+            " thumbnail TEXT,"
+            " UNIQUE (customer_id, task_id))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_generations_customer"
+            " ON generations (customer_id, created_at DESC, id DESC)"
+        )
+        self._conn.commit()
+
+    def add(self, customer_id: str, task_id: str, prompt: str, toggles: dict,
+            reference_hashes: List[str], filepath: str, image_url: Optional[str],
+            created_at: Optional[float] = None, durations: Optional[dict] = None) -> Optional[int]:
+        completed_at = time.time()
+        thumbnail = self.make_thumbnail(filepath, task_id)
+
+        try:
+            with self._lock:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO generations (customer_id, task_id, prompt, toggles,"
+                    " reference_hashes, created_at, completed_at, durations, filepath, image_url, thumbnail)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        customer_id,
+                        task_id,
+                        prompt,
+                        json.dumps(toggles, ensure_ascii=False),
+                        json.dumps(reference_hashes),
+                        created_at or completed_at,
+                        completed_at,
+                        json.dumps(durations or {}),
+                        filepath,
+                        image_url,
+                        thumbnail
+                    )
+                )
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка записи истории для задачи {task_id}: {e}")
+            return None
+
+        if cursor.rowcount:
+            logger.info(f"Генерация {task_id} добавлена в историю клиента {customer_id}")
+            return cursor.lastrowid
+        return None
+
+    @staticmethod
+    def _to_entry(row: tuple) -> dict:
+        entry = dict(zip(_COLUMNS, row))
+        for column in _JSON_COLUMNS:
+            entry[column] = json.loads(entry[column])
+        return entry
+
+    def page(self, customer_id: str, limit: int,
+             after: Optional[Cursor] = None) -> Tuple[List[dict], Optional[Cursor]]:
+        query = f"SELECT {', '.join(_COLUMNS)} FROM generations WHERE customer_id = ?"
+        params = [customer_id]
+        if after is not None:
+            # Сравнение пар SQLite превращает в диапазон по индексу
+            query += " AND (created_at, id) < (?, ?)"
+            params += [after[0], after[1]]
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        try:
+            with self._lock:
+                rows = self._conn.execute(query, params).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка чтения истории клиента {customer_id}: {e}")
+            return [], None
+
+        entries = [self._to_entry(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = entries[-1]
+            next_cursor = (last["created_at"], last["id"])
+        return entries, next_cursor
+
+    def count(self, customer_id: str) -> int:
+        try:
+            with self._lock:
+                return self._conn.execute(
+                    "SELECT COUNT(*) FROM generations WHERE customer_id = ?", (customer_id,)
+                ).fetchone()[0]
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка чтения истории клиента {customer_id}: {e}")
+            return 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisHistory(GenerationHistory):
+    """
+    История на сервере Redis общего состояния - одна для реплик на любых машинах.
+    Запись хранится как JSON, а индекс клиента - отсортированное множество с одинаковым
+    весом, члены которого "<created_at>:<id>" фиксированной ширины: лексикографический
+    порядок совпадает с порядком (created_at, id), и страница выбирается диапазоном
+    ZREVRANGEBYLEX от курсора. Миниатюры хранятся на сервере и кэшируются в thumbnails_dir.
+    """
+
+    def __init__(self, backend: RedisBackend, thumbnails_dir: str):
+        super().__init__(thumbnails_dir)
+        self.backend = backend
+        self.prefix = f"{backend.prefix}history:"
+
+    @staticmethod
+    def _member(created_at: float, entry_id: int) -> str:
+        return f"{created_at:020.6f}:{entry_id:012d}"
+
+    def _entry_key(self, entry_id: int) -> str:
+        return f"{self.prefix}entry:{entry_id}"
+
+    def _index_key(self, customer_id: str) -> str:
+        return f"{self.prefix}customer:{customer_id}"
+
+    def add(self, customer_id: str, task_id: str, prompt: str, toggles: dict,
+            reference_hashes: List[str], filepath: str, image_url: Optional[str],
+            created_at: Optional[float] = None, durations: Optional[dict] = None) -> Optional[int]:
+        completed_at = time.time()
+        thumbnail = self.make_thumbnail(filepath, task_id)
+
+        try:
+            entry_id = self.backend.execute("INCR", f"{self.prefix}seq")
+            # Одна запись на задачу клиента, даже если ее одновременно записывают две реплики
+            if self.backend.execute("SET", f"{self.prefix}task:{customer_id}:{task_id}",
+                                    str(entry_id), "NX") is None:
+                return None
+
+            if thumbnail:
+                with open(thumbnail, 'rb') as f:
+                    self.backend.put_blob(f"thumbnail_{task_id}", f.read())
+            entry = {
+                "id": entry_id,
+                "customer_id": customer_id,
+                "task_id": task_id,
+                "prompt": prompt,
+                "toggles": toggles,
+                "reference_hashes": reference_hashes,
+                "created_at": created_at or completed_at,
+                "completed_at": completed_at,
+                "durations": durations or {},
+                "filepath": filepath,
+                "image_url": image_url,
+                "thumbnail": thumbnail
+            }
+            self.backend.execute("SET", self._entry_key(entry_id), json.dumps(entry, ensure_ascii=False))
+            self.backend.execute("ZADD", self._index_key(customer_id), "0",
+                                 self._member(entry["created_at"], entry_id))
+        except Exception as e:
+            logger.warning(f"Ошибка записи истории для задачи {task_id}: {e}")
+            return None
+
+        logger.info(f"Генерация {task_id} добавлена в историю клиента {customer_id}")
+        return entry_id
+
+    def page(self, customer_id: str, limit: int,
+             after: Optional[Cursor] = None) -> Tuple[List[dict], Optional[Cursor]]:
+        upper = f"({self._member(*after)}" if after is not None else "+"
+        try:
+            members = self.backend.execute("ZREVRANGEBYLEX", self._index_key(customer_id), upper, "-",
+                                           "LIMIT", "0", str(limit + 1))
+            ids = [int(member.rsplit(b":", 1)[1]) for member in members[:limit]]
+            values = self.backend.execute("MGET", *[self._entry_key(i) for i in ids]) if ids else []
+        except Exception as e:
+            logger.warning(f"Ошибка чтения истории клиента {customer_id}: {e}")
+            return [], None
+
+        entries = [json.loads(value.decode('utf-8')) for value in values if value is not None]
+        next_cursor = None
+        if len(members) > limit and entries:
+            last = entries[-1]
+            next_cursor = (last["created_at"], last["id"])
+        return entries, next_cursor
+
+    def count(self, customer_id: str) -> int:
+        try:
+            return self.backend.execute("ZCARD", self._index_key(customer_id))
+        except Exception as e:
+            logger.warning(f"Ошибка чтения истории клиента {customer_id}: {e}")
+            return 0
+
+    def load_thumbnail(self, entry: dict) -> Optional[str]:
+        """Миниатюра из кэша этой реплики; при первом обращении скачивается с сервера"""
+        thumb_path = self._thumbnail_path(entry["task_id"])
+        if os.path.exists(thumb_path):
+            return thumb_path
+        if not entry["thumbnail"]:
+            return None
+
+        try:
+            data = self.backend.get_blob(f"thumbnail_{entry['task_id']}")
+        except Exception as e:
+            logger.warning(f"Ошибка чтения миниатюры {entry['task_id']}: {e}")
+            return None
+        if not data:
+            return None
+
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        tmp_path = f"{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, thumb_path)
+        return thumb_path
+
+
+def create_history(backend: SharedStateBackend, path: str = HISTORY_DB_PATH) -> GenerationHistory:
+    """
+    История рядом с общим состоянием: на сервере Redis, если он используется,
+    иначе - в SQLite-файле path
+    """
+    if isinstance(backend, RedisBackend):
+        return RedisHistory(backend, os.path.join(os.path.dirname(os.path.abspath(path)), "thumbnails"))
+    return SQLiteHistory(path)
@@ -0,0 +1,115 @@
+import io
+import logging
+import os
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Размер хэша: 8x8 низких частот DCT = 64 бита
+HASH_SIZE = 8
+# Изображение уменьшается до (HASH_SIZE * HIGHFREQ_FACTOR)^2 перед DCT
+HIGHFREQ_FACTOR = 4
+# Максимальное расстояние Хэмминга, при котором изображения считаются дубликатами
+DEDUP_MAX_DISTANCE = int(os.environ.get("DEDUP_MAX_DISTANCE", "6"))
+
+_IMG_SIZE = HASH_SIZE * HIGHFREQ_FACTOR
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Матрица DCT-II размера n x n (ортонормированная)"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0, :] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(_IMG_SIZE)
+
+
+def _load_grayscale(image_bytes: bytes) -> Optional[np.ndarray]:
+    """Декодирует изображение и уменьшает его до квадрата в оттенках серого"""
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.draft('L', (_IMG_SIZE * 2, _IMG_SIZE * 2))
+        image = image.convert('L').resize((_IMG_SIZE, _IMG_SIZE), Image.LANCZOS)
+        return np.asarray(image, dtype=np.float64)
+    except Exception as e:
+        logger.warning(f"Не удалось вычислить перцептивный хэш: {e}")
+        return None
+
+
+def perceptual_hashes(images: List[bytes]) -> List[Optional[str]]:
+    """
+    Вычисляет перцептивные хэши (pHash) для пачки изображений.
+    DCT, медианы и упаковка битов считаются одной векторной операцией на всю пачку.
+    Возвращает 16-символьные hex-строки; None для изображений, которые не удалось декодировать.
+    """
+    pixels = [_load_grayscale(image_bytes) for image_bytes in images]
+    valid = [i for i, p in enumerate(pixels) if p is not None]
+    hashes: List[Optional[str]] = [None] * len(images)
+
+    if not valid:
+        return hashes
+
+    batch = np.stack([pixels[i] for i in valid])                 # (N, 32, 32)
+    dct = _DCT @ batch @ _DCT.T                                   # (N, 32, 32)
+    low = dct[:, :HASH_SIZE, :HASH_SIZE].reshape(len(valid), -1)  # (N, 64)
+    bits = low > np.median(low, axis=1, keepdims=True)
+    packed = np.packbits(bits, axis=1)                            # (N, 8)
+
+    for row, i in enumerate(valid):
+        hashes[i] = packed[row].tobytes().hex()
+    return hashes
+
+
+def _to_array(hashes: List[str]) -> np.ndarray:
+    return np.frombuffer(b"".join(bytes.fromhex(h) for h in hashes), dtype=np.uint8).reshape(len(hashes), -1)
+
+
+def hamming_distances(hashes_a: List[str], hashes_b: List[str]) -> np.ndarray:
+    """Матрица попарных расстояний Хэмминга между двумя списками хэшей"""
+    if not hashes_a or not hashes_b:
+        return np.zeros((len(hashes_a), len(hashes_b)), dtype=np.int64)
+
+    a = _to_array(hashes_a)
+    b = _to_array(hashes_b)
+    xor = a[:, None, :] ^ b[None, :, :]                           # (N, M, 8)
+    return np.unpackbits(xor, axis=2).sum(axis=2, dtype=np.int64)
+
+
+def find_duplicates(new_hashes: List[Optional[str]], known_hashes: List[str],
+                    max_distance: int = DEDUP_MAX_DISTANCE) -> List[Optional[int]]:
+    """
+    Ищет почти-дубликаты для каждого нового хэша.
+    Индексы ответа: 0..len(known_hashes)-1 - совпадение с уже известным изображением,
+    len(known_hashes)+j - совпадение с более ранним изображением j этой же пачки,
+    None - изображение уникально.
+    """
+    result: List[Optional[int]] = [None] * len(new_hashes)
+    present = [i for i, h in enumerate(new_hashes) if h is not None]
+    if not present:
+        return result
+
+    candidates = known_hashes + [new_hashes[i] for i in present]
+    distances = hamming_distances([new_hashes[i] for i in present], candidates)
+    matches = distances <= max_distance
+
+    # Внутри пачки изображение может совпасть только с более ранним
+    n_known = len(known_hashes)
+    batch_part = matches[:, n_known:]
+    batch_part &= np.tri(len(present), k=-1, dtype=bool)
+
+    # Из подходящих кандидатов выбираем ближайший
+    masked = np.where(matches, distances, np.iinfo(np.int64).max)
+    best = masked.argmin(axis=1)
+
+    for row, i in enumerate(present):
+        if not matches[row].any():
+            continue
+        hit = int(best[row])
+        result[i] = hit if hit < n_known else n_known + present[hit - n_known]
+    return result
@@ -0,0 +1,513 @@
+"""
+Нагрузочное тестирование приложения.
+
+Запускает N имитированных пользовательских сессий через настоящий main()
+(загрузка, тумблеры, генерация, ожидание, скачивание) с помощью
+streamlit.testing.v1.AppTest. Yes Ai и Freeimage.host заменяются локальным
+HTTP-сервером с настраиваемыми задержками.
+
+Пример:
+    python loadtest.py --sessions 20 --images 3 --gen-latency 5
+"""
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Скрипт сессии: подменяет st.file_uploader и вызывает настоящий main().
+# Все сессии используют один файл скрипта: от его пути зависят ID виджетов,
+# а AppTest кэширует список страниц глобально
+SESSION_SCRIPT = f"""
+import sys
+sys.path.insert(0, {REPO_DIR!r})
+import loadtest
+loadtest.run_app_session()
+"""
+
+
+class MockBackends:
+    """Локальная замена Yes Ai и Freeimage.host"""
+
+    def __init__(self, gen_latency: float = 5.0, upload_latency: float = 0.3):
+        self.gen_latency = gen_latency
+        self.upload_latency = upload_latency
+        self.images = {}
+        self.tasks = {}
+        # Счетчики: загрузки на Freeimage и референсы, полученные сервисом генерации
+        self.uploads = 0
+        self.references = {"url": 0, "inline": 0}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"Mock-сервер запущен: {self.base_url}")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reference_valid(self, reference: str) -> bool:
+        if reference.startswith("data:"):
+            header, _, data = reference.partition(",")
+            try:
+                Image.open(io.BytesIO(base64.b64decode(data, validate=True))).verify()
+            except Exception:
+                return False
+            kind = "inline"
+        else:
+            with self.lock:
+                if reference.rsplit("/", 1)[-1] not in self.images:
+                    return False
+            kind = "url"
+        with self.lock:
+            self.references[kind] += 1
+        return True
+
+    def _render_result(self) -> bytes:
+        image = Image.new("RGB", (576, 1024), tuple(random.randrange(256) for _ in range(3)))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG")
+        return buffer.getvalue()
+
+    def _handler_class(self):
+        backends = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, payload: dict, status: int = 200):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def _send_image(self, with_body: bool):
+                image_id = self.path.rsplit("/", 1)[-1]
+                with backends.lock:
+                    data = backends.images.get(image_id)
+                if data is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if with_body:
+                    self.wfile.write(data)
+
+            def do_HEAD(self):
+                self._send_image(with_body=False)
+
+            def do_GET(self):
+                if self.path.startswith("/images/"):
+                    self._send_image(with_body=True)
+                    return
+
+                task_id = self.path.rsplit("/", 1)[-1]
+                with backends.lock:
+                    task = backends.tasks.get(task_id)
+                if task is None:
+                    self._send_json({"error": "TASK_NOT_FOUND"}, 404)
+                    return
+
+                data = {"id": task_id, "status": 1, "result_url": None}
+                if time.time() - task["created_at"] >= backends.gen_latency:
+                    if task["image_id"] is None:
+                        image_id = f"{uuid.uuid4().hex}.jpg"
+                        with backends.lock:
+                            backends.images[image_id] = backends._render_result()
+                        task["image_id"] = image_id
+                    data.update(status=2, result_url=f"{backends.base_url}/images/{task['image_id']}")
+                self._send_json({"results": {"generation_data": data}})
+
+            def do_POST(self):
+                body = self._read_body()
+
+                if self.path.endswith("/upload"):
+                    time.sleep(backends.upload_latency)
+                    form = parse_qs(body.decode("utf-8"))
+                    image_id = f"{uuid.uuid4().hex}.jpg"
+                    with backends.lock:
+                        backends.images[image_id] = base64.b64decode(form["source"][0])
+                        backends.uploads += 1
+                    self._send_json({
+                        "status_code": 200,
+                        "success": {"code": 200},
+                        "image": {"url": f"{backends.base_url}/images/{image_id}"}
+                    })
+                    return
+
+                # Как настоящий сервис: встроенные референсы декодируются, ссылки скачиваются
+                for reference in json.loads(body).get("references_urls", []):
+                    if not backends.reference_valid(reference):
+                        self._send_json({"error": "REFERENCES_URLS_NOT_VALID"}, 400)
+                        return
+
+                task_id = uuid.uuid4().hex
+                with backends.lock:
+                    backends.tasks[task_id] = {
+                        "created_at": time.time(),
+                        "customer_id": json.loads(body).get("customer_id"),
+                        "image_id": None
+                    }
+                self._send_json({"results": {"generation_data": {"id": task_id, "status": 1}}})
+
+        return Handler
+
+
+class FakeUploadedFile(io.BytesIO):
+    """Объект с интерфейсом UploadedFile из st.file_uploader"""
+
+    def __init__(self, name: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+        self.type = "image/jpeg"
+        self.file_id = uuid.uuid4().hex
+
+
+def run_app_session():
+    """Точка входа скрипта AppTest: выполняет один rerun настоящего приложения"""
+    import streamlit as st
+    import app
+
+    # Файлы сессии кладет в session_state драйвер нагрузки
+    app.st.file_uploader = lambda *args, **kwargs: st.session_state.get("_loadtest_files")
+    app.main()
+
+
+def install_concurrent_apptest():
+    """
+    Готовит AppTest 1.28 к параллельным сессиям в одном процессе:
+    - AppTest на время каждого прогона подменяет глобальный Runtime и затем сбрасывает его,
+      поэтому закрепляем один общий mock-runtime;
+    - прогон считается завершенным до события SHUTDOWN, и под нагрузкой AppTest
+      не находит его данных, поэтому дожидаемся завершения потока скрипта;
+    - блоки st.container() не имеют типа, и разбор дерева элементов падает,
+      поэтому такие блоки разбираются как безымянные.
+    """
+    from unittest.mock import MagicMock
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.testing.v1 import element_tree
+    from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+    mock_runtime = MagicMock(spec=Runtime)
+    mock_runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    mock_runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: mock_runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+
+    original_run = LocalScriptRunner.run
+
+    def run_and_join(self, *args, **kwargs):
+        try:
+            return original_run(self, *args, **kwargs)
+        finally:
+            self.join()
+
+    LocalScriptRunner.run = run_and_join
+
+    original_block_init = element_tree.Block.__init__
+
+    def block_init(self, proto, root):
+        if proto is not None and proto.WhichOneof("type") is None:
+            proto = None
+        original_block_init(self, proto, root)
+
+    element_tree.Block.__init__ = block_init
+
+
+def make_test_images(count: int, seed: int) -> List[FakeUploadedFile]:
+    rng = random.Random(seed)
+    files = []
+    for i in range(count):
+        # Случайная сетка 8x8 цветов, растянутая до размера фото с полки
+        image = Image.new("RGB", (8, 8))
+        image.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(64)])
+        image = image.resize((1280, 960), Image.NEAREST)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=85)
+        files.append(FakeUploadedFile(f"shelf_{seed}_{i}.jpg", buffer.getvalue()))
+    return files
+
+
+def read_rss() -> int:
+    """Текущий RSS процесса в байтах"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ResourceSampler:
+    """Фоновый замер числа потоков и RSS"""
+
+    def __init__(self, interval: float = 0.2):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self.peak_rss = read_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss = max(self.peak_rss, read_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_session(index: int, args, shared_files: Optional[List[FakeUploadedFile]]) -> dict:
+    """Проводит одну сессию через весь сценарий и возвращает замеры"""
+    from streamlit.testing.v1 import AppTest
+
+    timeout = args.gen_latency + 60
+    files = shared_files or make_test_images(args.images, seed=index)
+    rerun_latencies = []
+    result = {"session": index, "ok": False}
+
+    def rerun(action, interactive: bool = True):
+        # Rerun генерации включает все ожидание результата - в задержку интерфейса его не считаем
+        started = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - started
+        if interactive:
+            rerun_latencies.append(elapsed)
+        return elapsed
+
+    try:
+        at = AppTest.from_file(args.script_path, default_timeout=timeout)
+
+        # Загрузка
+        at.session_state["_loadtest_files"] = files
+        result["upload_seconds"] = rerun(at.run)
+
+        # Тумблеры
+        rerun(at.toggle(key="toggle_price_tags").set_value(True).run)
+        rerun(at.toggle(key="toggle_messy_shelf").set_value(True).run)
+
+        # Пользователь пишет промпт
+        time.sleep(args.think_time)
+
+        # Генерация и ожидание результата
+        generate = next(b for b in at.button if b.label == "🚀 Сгенерировать")
+        result["customer_id"] = at.session_state["customer_id"]
+        result["clicked_at"] = time.time()
+        result["generation_seconds"] = rerun(generate.click().run, interactive=False)
+
+        # Скачивание
+        path = at.session_state["last_result_path"]
+        if at.exception or not path or not os.path.exists(path):
+            result["error"] = str(at.exception[0].value) if at.exception else "нет результата"
+        else:
+            with open(path, "rb") as f:
+                result["result_bytes"] = len(f.read())
+            result["ok"] = True
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["rerun_latencies"] = rerun_latencies
+    return result
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def summarize(results: List[dict], sampler: ResourceSampler, baseline_rss: int,
+              baseline_threads: int, wall_seconds: float) -> dict:
+    reruns = [latency for r in results for latency in r["rerun_latencies"]]
+    uploads = [r["upload_seconds"] for r in results if "upload_seconds" in r]
+    generations = [r["generation_seconds"] for r in results if r.get("ok")]
+    submits = [r["submit_seconds"] for r in results if "submit_seconds" in r]
+    sessions = len(results)
+
+    def stats(values):
+        summary = {f"p{p}": round(percentile(values, p), 3) for p in (50, 90, 95, 99)}
+        summary["max"] = round(max(values), 3) if values else 0.0
+        return summary
+
+    def rounded(value):
+        return round(value, 3) if value is not None else None
+
+    per_session = [
+        {
+            "session": r["session"],
+            "ok": r.get("ok", False),
+            "rerun_p50": rounded(percentile(r["rerun_latencies"], 50)) if r["rerun_latencies"] else None,
+            "rerun_max": rounded(max(r["rerun_latencies"], default=None)),
+            "upload": rounded(r.get("upload_seconds")),
+            "generation": rounded(r.get("generation_seconds")),
+            "submit": rounded(r.get("submit_seconds")),
+            "error": r.get("error"),
+        }
+        for r in results
+    ]
+
+    return {
+        "sessions": sessions,
+        "succeeded": sum(1 for r in results if r.get("ok")),
+        "errors": [r["error"] for r in results if r.get("error")],
+        "wall_seconds": round(wall_seconds, 2),
+        "rerun_latency": stats(reruns),
+        "upload_latency": stats(uploads),
+        "generation_latency": stats(generations),
+        "submit_latency": stats(submits),
+        "peak_threads": sampler.peak_threads,
+        "threads_per_session": round((sampler.peak_threads - baseline_threads) / max(sessions, 1), 2),
+        "peak_rss_mb": round(sampler.peak_rss / 2 ** 20, 1),
+        "rss_per_session_mb": round((sampler.peak_rss - baseline_rss) / max(sessions, 1) / 2 ** 20, 2),
+        "per_session": per_session,
+    }
+
+
+def print_report(report: dict):
+    print(f"Сессий: {report['sessions']}, успешно: {report['succeeded']}, время: {report['wall_seconds']} с")
+    for name, title in (("rerun_latency", "Rerun (без генерации)"),
+                        ("upload_latency", "Загрузка"),
+                        ("generation_latency", "Генерация (end-to-end)"),
+                        ("submit_latency", "От нажатия до отправки задачи")):
+        values = ", ".join(f"{k}={v:.3f}" for k, v in report[name].items())
+        print(f"{title}, с: {values}")
+    print(f"Задач создано на mock-сервере: {report['upstream_tasks']}")
+    print(f"Загрузок на mock Freeimage: {report['upstream_uploads']}, референсов по ссылке: "
+          f"{report['upstream_references']['url']}, встроенных: {report['upstream_references']['inline']}")
+    print(f"Потоки: пик {report['peak_threads']}, на сессию {report['threads_per_session']}")
+    print(f"RSS: пик {report['peak_rss_mb']} МБ, на сессию {report['rss_per_session_mb']} МБ")
+    for error in report["errors"][:10]:
+        print(f"Ошибка: {error}")
+
+    def cell(value):
+        return f"{value:.3f}" if value is not None else "-"
+
+    print()
+    print(f"{'Сессия':>6} {'OK':>3} {'rerun p50':>10} {'rerun max':>10} {'загрузка':>9} "
+          f"{'генерация':>10} {'отправка':>9}")
+    for s in report["per_session"]:
+        print(f"{s['session']:>6} {'да' if s['ok'] else 'нет':>3} {cell(s['rerun_p50']):>10} "
+              f"{cell(s['rerun_max']):>10} {cell(s['upload']):>9} {cell(s['generation']):>10} "
+              f"{cell(s['submit']):>9}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование генератора изображений")
+    parser.add_argument("--sessions", type=int, default=10, help="количество сессий")
+    parser.add_argument("--concurrency", type=int, default=0, help="одновременных сессий (по умолчанию все)")
+    parser.add_argument("--images", type=int, default=2, help="изображений на сессию")
+    parser.add_argument("--shared-images", action="store_true", help="все сессии загружают одни и те же файлы")
+    parser.add_argument("--gen-latency", type=float, default=5.0, help="время генерации mock-сервером, с")
+    parser.add_argument("--upload-latency", type=float, default=0.3, help="время загрузки mock-сервером, с")
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="пауза между выбором файлов и нажатием «Сгенерировать», с")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="интервал опроса статуса задачи, с")
+    parser.add_argument("--inline", action="store_true", help="встраивать небольшие референсы в запрос (data URI)")
+    parser.add_argument("--json", dest="json_path", help="сохранить отчет в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    backends = MockBackends(args.gen_latency, args.upload_latency)
+    backends.start()
+
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    # Настройки приложения должны быть заданы до импорта app
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    os.environ["YESAI_API_URL"] = f"{backends.base_url}/generations"
+    os.environ["FREEIMAGE_API_URL"] = f"{backends.base_url}/upload"
+    os.environ["POLL_WAIT_TIME"] = str(args.poll_interval)
+    os.environ["POLL_MAX_ATTEMPTS"] = str(int(args.gen_latency / args.poll_interval) + 20)
+    os.environ["STREAMLIT_LOGGER_LEVEL"] = "warning"
+    os.environ["SHARED_STATE_URL"] = f"sqlite:///{os.path.join(workdir, 'state.sqlite3')}"
+    os.environ["INLINE_REFERENCES"] = "1" if args.inline else "0"
+    os.chdir(workdir)
+
+    args.script_path = os.path.join(workdir, "loadtest_session.py")
+    with open(args.script_path, "w") as f:
+        f.write(SESSION_SCRIPT)
+
+    shared_files = make_test_images(args.images, seed=0) if args.shared_images else None
+    concurrency = args.concurrency or args.sessions
+
+    install_concurrent_apptest()
+    baseline_rss = read_rss()
+    baseline_threads = threading.active_count()
+    started = time.perf_counter()
+
+    with ResourceSampler() as sampler, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda i: run_session(i, args, shared_files), range(args.sessions)))
+
+    # Время от нажатия до получения задачи сервисом генерации
+    task_times = {task["customer_id"]: task["created_at"] for task in backends.tasks.values()}
+    for r in results:
+        if r.get("customer_id") in task_times:
+            r["submit_seconds"] = task_times[r["customer_id"]] - r["clicked_at"]
+
+    report = summarize(results, sampler, baseline_rss, baseline_threads, time.perf_counter() - started)
+    report["upstream_tasks"] = len(backends.tasks)
+    report["upstream_uploads"] = backends.uploads
+    report["upstream_references"] = backends.references
+    backends.stop()
+
+    print_report(report)
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    return 0 if report["succeeded"] == report["sessions"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
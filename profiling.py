@@ -0,0 +1,186 @@
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Профилирование включается переменной окружения APP_PROFILE=1
+# или на время из панели администратора
+PROFILE_DIR = os.environ.get("APP_PROFILE_DIR", "profiles")
+# Доля профилируемых операций (0..1)
+PROFILE_SAMPLE_RATE = float(os.environ.get("APP_PROFILE_SAMPLE_RATE", "1.0"))
+# Сколько файлов хранить в каталоге; старые удаляются
+PROFILE_MAX_FILES = int(os.environ.get("APP_PROFILE_MAX_FILES", "200"))
+# Сколько строк выводить в текстовых отчетах
+PROFILE_TOP_N = int(os.environ.get("APP_PROFILE_TOP_N", "30"))
+
+_lock = threading.Lock()
+_local = threading.local()
+
+# Момент, до которого профилирование включено. Проверка одного числа -
+# единственные накладные расходы выключенного режима
+_enabled_until = float("inf") if os.environ.get("APP_PROFILE") == "1" else 0.0
+_sample_rate = PROFILE_SAMPLE_RATE
+_track_allocations = os.environ.get("APP_PROFILE_ALLOC") == "1"
+# tracemalloc запущен профилировщиком (а не, например, через -X tracemalloc)
+_tracing_started = False
+
+
+def _start_tracing() -> None:
+    global _tracing_started
+    with _lock:
+        if tracemalloc.is_tracing():
+            return
+        tracemalloc.start()
+        _tracing_started = True
+
+
+def _stop_tracing() -> None:
+    """Вне окна профилирования tracemalloc только замедляет каждую аллокацию"""
+    global _tracing_started
+    with _lock:
+        if not _tracing_started:
+            return
+        _tracing_started = False
+        tracemalloc.stop()
+    logger.info("Отслеживание аллокаций остановлено")
+
+
+def enable(minutes: Optional[float] = None, track_allocations: bool = False,
+           sample_rate: float = PROFILE_SAMPLE_RATE) -> None:
+    """Включает профилирование на заданное число минут (None - бессрочно)"""
+    global _enabled_until, _sample_rate, _track_allocations
+    with _lock:
+        _sample_rate = sample_rate
+        _track_allocations = track_allocations
+        _enabled_until = float("inf") if minutes is None else time.time() + minutes * 60
+    if not track_allocations:
+        _stop_tracing()
+    logger.info(f"Профилирование включено: {minutes or 'бессрочно'} мин, "
+                f"выборка {sample_rate}, аллокации {track_allocations}")
+
+
+def disable() -> None:
+    global _enabled_until
+    with _lock:
+        _enabled_until = 0.0
+    _stop_tracing()
+    logger.info("Профилирование выключено")
+
+
+def is_enabled() -> bool:
+    return _enabled_until > time.time()
+
+
+def status() -> dict:
+    """Состояние режима для панели администратора"""
+    enabled = is_enabled()
+    return {
+        "enabled": enabled,
+        "remaining_seconds": None if not enabled or _enabled_until == float("inf")
+        else int(_enabled_until - time.time()),
+        "sample_rate": _sample_rate,
+        "track_allocations": _track_allocations,
+        "directory": os.path.abspath(PROFILE_DIR),
+    }
+
+
+def _rotate():
+    """Оставляет в каталоге не более PROFILE_MAX_FILES последних файлов"""
+    try:
+        files = [os.path.join(PROFILE_DIR, f) for f in os.listdir(PROFILE_DIR)]
+        files.sort(key=os.path.getmtime)
+        for path in files[:-PROFILE_MAX_FILES]:
+            os.remove(path)
+    except OSError as e:
+        logger.warning(f"Ошибка ротации профилей: {e}")
+
+
+def _write_reports(name: str, elapsed: float, profiler: cProfile.Profile,
+                   snapshot_before: Optional[tracemalloc.Snapshot]):
+    # Снимок памяти делаем до записи отчетов, чтобы в него не попали аллокации профилировщика
+    snapshot_after = None
+    if snapshot_before is not None and tracemalloc.is_tracing():
+        snapshot_after = tracemalloc.take_snapshot()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    base = os.path.join(PROFILE_DIR, f"{stamp}_{int(time.time() * 1000) % 1000:03d}_{name}")
+
+    profiler.dump_stats(f"{base}.prof")
+
+    report = io.StringIO()
+    report.write(f"{name}: {elapsed:.3f} с\n\n")
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    with open(f"{base}.txt", "w") as f:
+        f.write(report.getvalue())
+
+    if snapshot_after is not None:
+        with open(f"{base}_alloc.txt", "w") as f:
+            f.write(f"{name}: top-{PROFILE_TOP_N} аллокаций\n\n")
+            for stat in snapshot_after.compare_to(snapshot_before, "lineno")[:PROFILE_TOP_N]:
+                f.write(f"{stat}\n")
+
+    _rotate()
+
+
+@contextmanager
+def profile(name: str):
+    """
+    Профилирует блок кода, если режим включен.
+    Вложенные операции того же потока попадают в профиль внешней.
+    """
+    if _enabled_until < time.time():
+        # Окно профилирования истекло: tracemalloc больше не нужен
+        if _tracing_started:
+            _stop_tracing()
+        yield
+        return
+    if getattr(_local, "active", False) or random.random() >= _sample_rate:
+        yield
+        return
+
+    snapshot_before = None
+    if _track_allocations:
+        _start_tracing()
+        snapshot_before = tracemalloc.take_snapshot()
+
+    profiler = cProfile.Profile()
+    _local.active = True
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _local.active = False
+        try:
+            _write_reports(name, time.perf_counter() - started, profiler, snapshot_before)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить профиль {name}: {e}")
+
+
+def profiled(name: Optional[str] = None):
+    """Декоратор: профилирует каждый вызов функции, если режим включен"""
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _enabled_until < time.time() and not _tracing_started:
+                return func(*args, **kwargs)
+            with profile(label):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
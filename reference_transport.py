@@ -0,0 +1,108 @@
+import logging
+import os
+from typing import Callable, List, Optional, Tuple
+
+import upload_pipeline
+
+logger = logging.getLogger(__name__)
+
+# Принимает ли сервис генерации референсы в виде data URI в references_urls.
+# Встроенные референсы не требуют загрузки на Freeimage.host, проверки ссылки
+# и скачивания изображения сервисом генерации
+INLINE_REFERENCES = os.environ.get("INLINE_REFERENCES", "0") == "1"
+# Изображения с файлом крупнее этого размера всегда передаются ссылкой
+INLINE_MAX_IMAGE_KB = int(os.environ.get("INLINE_MAX_IMAGE_KB", "2048"))
+# Суммарный размер встроенных референсов в одном запросе - в base64, как они занимают тело запроса
+INLINE_MAX_TOTAL_KB = int(os.environ.get("INLINE_MAX_TOTAL_KB", "8192"))
+
+
+def can_inline(size: int) -> bool:
+    """Может ли изображение такого размера быть встроено в запрос (без загрузки заранее)"""
+    return INLINE_REFERENCES and size <= INLINE_MAX_IMAGE_KB * 1024
+
+
+def encoded_size(size: int) -> int:
+    """Размер изображения из size байт в base64 (data URI без префикса)"""
+    return 4 * ((size + 2) // 3)
+
+
+def split_references(references: List[dict]) -> Tuple[List[dict], List[dict]]:
+    """
+    Выбирает способ передачи для каждого референса запроса: возвращает (встроенные, по ссылке).
+    Встраиваются сначала самые маленькие изображения, пока не исчерпан общий лимит
+    (по размеру в base64: в запросе изображение на треть больше файла).
+    """
+    if not INLINE_REFERENCES:
+        return [], list(references)
+
+    inline, by_url = [], []
+    budget = INLINE_MAX_TOTAL_KB * 1024
+    for reference in sorted(references, key=lambda ref: len(ref["bytes"])):
+        size = len(reference["bytes"])
+        if can_inline(size) and encoded_size(size) <= budget:
+            inline.append(reference)
+            budget -= encoded_size(size)
+        else:
+            by_url.append(reference)
+    return inline, by_url
+
+
+class ReferenceTransport:
+    """Способ передачи референсов сервису генерации"""
+
+    name = ""
+
+    def encode(self, references: List[dict]) -> List[Optional[str]]:
+        """Значения для references_urls в порядке references; None - референс недоступен"""
+        raise NotImplementedError
+
+
+class UrlTransport(ReferenceTransport):
+    """Ссылки на Freeimage.host: сервис генерации сам скачивает изображения"""
+
+    name = "url"
+
+    def __init__(self, uploader, upload: Callable[[dict], Optional[str]]):
+        """
+        uploader проверяет ссылки, upload загружает референс без ссылки
+        с учетом общего кэша загрузок (app.upload_reference)
+        """
+        self.uploader = uploader
+        self.upload = upload
+
+    def encode(self, references: List[dict]) -> List[Optional[str]]:
+        values = []
+        for reference in references:
+            # Присоединяемся к фоновой загрузке, если она еще идет
+            upload_pipeline.settle(reference, wait=True)
+            url = reference.get("url")
+            if not url:
+                # Загрузку откладывали в расчете на встраивание, либо фоновая загрузка
+                # отменена или не удалась - загружаем сейчас
+                url = self.upload(reference)
+                # Ссылку запоминаем в описании изображения, чтобы не загружать его повторно
+                reference.update(url=url, verified=False)
+            if url and not reference.get("verified"):
+                reference["verified"] = self.uploader.verify_image_url(url)
+            # None - проверка пропущена: ссылку проверит сам сервис генерации
+            values.append(url if url and reference["verified"] is not False else None)
+        return values
+
+
+class InlineTransport(ReferenceTransport):
+    """Изображения встраиваются в запрос как data URI"""
+
+    name = "inline"
+
+    def __init__(self, process_image: Callable[[bytes], Optional[dict]]):
+        self.process_image = process_image
+
+    def encode(self, references: List[dict]) -> List[Optional[str]]:
+        values = []
+        for reference in references:
+            processed = self.process_image(reference["bytes"])
+            if processed:
+                values.append(f"data:{processed['mime_type']};base64,{processed['data']}")
+            else:
+                values.append(None)
+        return values
@@ -0,0 +1,313 @@
+import logging
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+import requests.adapters
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def jittered_backoff(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    """Пауза перед повтором номер attempt: экспоненциальная, со случайной долей (full jitter)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Запрос не отправлен: сервис недавно отказывал и временно отключен"""
+
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f"Сервис {endpoint} временно недоступен, повтор через {int(retry_in) + 1} с")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+def payload_size(data=None, json=None, **kwargs) -> int:
+    """Примерный размер тела запроса в байтах (по строкам и байтам в data и json)"""
+    def size(value) -> int:
+        if isinstance(value, (str, bytes)):
+            return len(value)
+        if isinstance(value, dict):
+            return sum(size(k) + size(v) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return sum(size(v) for v in value)
+        return 0
+
+    return size(data) + size(json)
+
+
+class EndpointConfig:
+    """
+    Ограничения таймаута и параметры автомата отключения для одного endpoint.
+    timeout_per_mb - добавка к таймауту на каждый мегабайт тела запроса: адаптивный
+    таймаут учится на типичных запросах, и без нее крупное тело после серии мелких не успеет уйти.
+    """
+
+    def __init__(self, initial_timeout: float, min_timeout: float, max_timeout: float,
+                 failure_threshold: int = 5, reset_timeout: float = 30, max_retries: int = 2,
+                 timeout_per_mb: float = 0.0):
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_per_mb = timeout_per_mb
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_retries = max_retries
+
+
+class LatencyTracker:
+    """
+    Сглаженная (EWMA) задержка и ее разброс, как при расчете RTO в TCP.
+    Таймаут = задержка + 4 разброса, в пределах [min_timeout, max_timeout].
+    """
+
+    ALPHA = 0.125
+    BETA = 0.25
+
+    def __init__(self, config: EndpointConfig):
+        self.config = config
+        self.srtt = None
+        self.rttvar = None
+        self._lock = threading.Lock()
+
+    def observe(self, latency: float):
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = latency
+                self.rttvar = latency / 2
+            else:
+                self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - latency)
+                self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * latency
+
+    def timeout(self) -> float:
+        with self._lock:
+            if self.srtt is None:
+                return self.config.initial_timeout
+            value = self.srtt + 4 * self.rttvar
+        return min(max(value, self.config.min_timeout), self.config.max_timeout)
+
+
+class CircuitBreaker:
+    """
+    Автомат отключения: после failure_threshold отказов подряд запросы не отправляются
+    reset_timeout секунд, затем пропускается один пробный запрос.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, config: EndpointConfig):
+        self.name = name
+        self.config = config
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.config.reset_timeout - time.time())
+
+    def before_request(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if self.retry_in() > 0:
+                    raise CircuitOpenError(self.name, self.retry_in())
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    raise CircuitOpenError(self.name, self.config.reset_timeout)
+                self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Сервис {self.name} снова доступен")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.config.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Сервис {self.name} отключен на {self.config.reset_timeout} с "
+                                   f"после {self.failures} отказов")
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+class RetryBudget:
+    """
+    Общий для всех endpoint бюджет повторов: каждый запрос пополняет его на ratio,
+    каждый повтор расходует единицу. Не дает повторам умножать нагрузку на деградировавший сервис.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 0.5, max_tokens: float = 10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.updated_at) * self.min_per_second)
+        self.updated_at = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+# Начальные таймауты совпадают с прежними фиксированными значениями.
+# Тела загрузок (до 32 МБ) и запросов генерации со встроенными референсами велики:
+# на каждый мегабайт добавляется время передачи при ~4 Мбит/с.
+# Опрос статуса не повторяется внутри запроса: его и так повторяет цикл опроса со своей паузой
+DEFAULT_ENDPOINTS = {
+    "yesai.submit": EndpointConfig(initial_timeout=60, min_timeout=10, max_timeout=60, timeout_per_mb=2),
+    "yesai.poll": EndpointConfig(initial_timeout=30, min_timeout=3, max_timeout=30, max_retries=0),
+    "freeimage.upload": EndpointConfig(initial_timeout=30, min_timeout=10, max_timeout=30, timeout_per_mb=2),
+    "freeimage.verify": EndpointConfig(initial_timeout=5, min_timeout=1, max_timeout=5),
+    "result.download": EndpointConfig(initial_timeout=30, min_timeout=5, max_timeout=30),
+}
+
+ENDPOINT_LABELS = {
+    "yesai.submit": "Yes Ai (генерация)",
+    "yesai.poll": "Yes Ai (статус задач)",
+    "freeimage.upload": "Freeimage.host (загрузка)",
+    "freeimage.verify": "Freeimage.host (проверка ссылок)",
+    "result.download": "Скачивание результатов",
+}
+
+
+class ResilientClient:
+    """
+    HTTP-клиент для внешних сервисов: адаптивные таймауты по endpoint,
+    повторы только идемпотентных запросов с бюджетом и джиттером, автоматы отключения.
+    """
+
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 8.0
+
+    def __init__(self, endpoints: Dict[str, EndpointConfig] = None, budget: RetryBudget = None):
+        endpoints = endpoints or DEFAULT_ENDPOINTS
+        self.latency = {name: LatencyTracker(config) for name, config in endpoints.items()}
+        self.breakers = {name: CircuitBreaker(name, config) for name, config in endpoints.items()}
+        self.configs = endpoints
+        self.budget = budget or RetryBudget()
+
+        # Одна сессия на процесс: соединения с сервисами переиспользуются всеми пользователями
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=50)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def _is_failure(response: requests.Response) -> bool:
+        return response.status_code >= 500 or response.status_code == 429
+
+    def request(self, endpoint: str, method: str, url: str,
+                idempotent: Optional[bool] = None, **kwargs) -> requests.Response:
+        """
+        Выполняет запрос через endpoint. Возвращает последний ответ сервиса
+        или выбрасывает последнее исключение requests (в том числе CircuitOpenError).
+        """
+        config = self.configs[endpoint]
+        breaker = self.breakers[endpoint]
+        tracker = self.latency[endpoint]
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        transfer_timeout = 0.0
+        if config.timeout_per_mb:
+            transfer_timeout = payload_size(**kwargs) / (1024 * 1024) * config.timeout_per_mb
+
+        attempt = 0
+        while True:
+            breaker.before_request()
+            timeout = tracker.timeout() + transfer_timeout
+            started = time.monotonic()
+            self.budget.deposit()
+
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except requests.exceptions.RequestException as e:
+                breaker.record_failure()
+                # Таймаут тоже говорит о задержке: учитываем его, чтобы таймаут мог расти
+                tracker.observe(time.monotonic() - started)
+                error, response = e, None
+            else:
+                tracker.observe(time.monotonic() - started)
+                if not self._is_failure(response):
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                error = None
+
+            # Повтор бессмысленен, если этот отказ отключил endpoint
+            if not idempotent or attempt >= config.max_retries or breaker.state == CircuitBreaker.OPEN \
+                    or not self.budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+
+            attempt += 1
+            delay = jittered_backoff(attempt, self.BACKOFF_BASE, self.BACKOFF_MAX)
+            logger.warning(f"{endpoint}: попытка {attempt} не удалась "
+                           f"({error or response.status_code}), повтор через {delay:.1f} с")
+            time.sleep(delay)
+
+    def warm_up(self, url: str, timeout: float = 5) -> None:
+        """
+        Открывает соединение с хостом и оставляет его в пуле сессии.
+        Ответ не важен и не влияет на таймауты и автоматы отключения.
+        """
+        try:
+            self.session.head(url, timeout=timeout, allow_redirects=False).close()
+            logger.info(f"Соединение с {url} прогрето")
+        except requests.exceptions.RequestException as e:
+            logger.info(f"Не удалось прогреть соединение с {url}: {e}")
+
+    def status(self) -> Dict[str, dict]:
+        """Состояние endpoint для интерфейса"""
+        return {
+            name: {
+                "label": ENDPOINT_LABELS.get(name, name),
+                "state": breaker.state,
+                "retry_in": breaker.retry_in() if breaker.state == CircuitBreaker.OPEN else 0,
+                "timeout": round(self.latency[name].timeout(), 1),
+            }
+            for name, breaker in self.breakers.items()
+        }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> ResilientClient:
+    """Общий клиент процесса: статистика и автоматы отключения едины для всех сессий"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ResilientClient()
+        return _client
@@ -0,0 +1,503 @@
+import json
+import logging
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+from urllib.parse import unquote, urlparse
+
+logger = logging.getLogger(__name__)
+
+# Адрес общего хранилища состояния. Все реплики приложения должны указывать
+# на одно и то же хранилище:
+#   sqlite:///shared_state/state.sqlite3  - файл SQLite, только реплики на одной машине
+#   redis://:password@host:6379/0         - сервер с протоколом Redis (несколько машин)
+SHARED_STATE_URL = os.environ.get("SHARED_STATE_URL", "sqlite:///shared_state/state.sqlite3")
+
+# Время жизни записей (в секундах)
+UPLOAD_TTL = 7 * 24 * 3600
+RESULT_TTL = 30 * 24 * 3600
+TASK_TTL = 24 * 3600
+JOB_TTL = 24 * 3600
+# Как часто SQLite-хранилище удаляет истекшие записи и файлы (в секундах)
+GC_INTERVAL = 3600
+
+
+class SharedStateError(Exception):
+    """Ошибка обращения к общему хранилищу"""
+
+
+class SharedStateBackend:
+    """
+    Интерфейс хранилища общего состояния.
+    Записи - JSON-словари в пространствах имен, бинарные данные хранятся отдельно.
+    """
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: dict, ttl: Optional[int] = None) -> None:
+        raise NotImplementedError
+
+    def set_if_absent(self, namespace: str, key: str, value: dict, ttl: Optional[int] = None) -> bool:
+        """Атомарно записывает значение, только если ключа нет. True, если запись сделана"""
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str) -> None:
+        raise NotImplementedError
+
+    def put_blob(self, key: str, data: bytes, ttl: Optional[int] = None) -> None:
+        raise NotImplementedError
+
+    def get_blob(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteBackend(SharedStateBackend):
+    """
+    Хранилище на SQLite и файлах для реплик на одной машине.
+    Файл работает в режиме WAL, которому нужна общая память процессов, поэтому
+    размещать его на сетевом томе (NFS, SMB) нельзя: для нескольких машин - RedisBackend.
+    Срок жизни файлов хранится в пространстве имен BLOBS; истекшие записи и файлы
+    удаляются не чаще раза в GC_INTERVAL при записи.
+    """
+
+    BLOBS = "blobs"
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        self.blobs_dir = os.path.join(directory, "blobs")
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.commit()
+        self._collected_at = 0.0
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM kv WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+        if row is None:
+            return None
+
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            self.delete(namespace, key)
+            return None
+        return json.loads(value)
+
+    def set(self, namespace: str, key: str, value: dict, ttl: Optional[int] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+            self._conn.commit()
+
+    def set_if_absent(self, namespace: str, key: str, value: dict, ttl: Optional[int] = None) -> bool:
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._lock:
+            # Истекшая запись считается отсутствующей
+            self._conn.execute(
+                "DELETE FROM kv WHERE namespace = ? AND key = ? AND expires_at < ?", (namespace, key, now)
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+            self._conn.commit()
+
+    def _blob_path(self, key: str) -> str:
+        safe_key = "".join(c if c.isalnum() or c in "-_." else "_" for c in key)
+        return os.path.join(self.blobs_dir, safe_key)
+
+    def _remove_blob_file(self, key: str) -> None:
+        try:
+            os.remove(self._blob_path(key))
+        except FileNotFoundError:
+            pass
+
+    def put_blob(self, key: str, data: bytes, ttl: Optional[int] = None) -> None:
+        # Пишем во временный файл и атомарно переименовываем,
+        # чтобы другие реплики не прочитали файл наполовину
+        path = self._blob_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.set(self.BLOBS, key, {"size": len(data)}, ttl)
+        self.collect_garbage()
+
+    def get_blob(self, key: str) -> Optional[bytes]:
+        if self.get(self.BLOBS, key) is None:
+            # Срок жизни истек
+            self._remove_blob_file(key)
+            return None
+        try:
+            with open(self._blob_path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def collect_garbage(self, force: bool = False) -> None:
+        """Удаляет истекшие записи всех пространств имен и файлы истекших blob"""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._collected_at < GC_INTERVAL:
+                return
+            self._collected_at = now
+            expired = [key for (key,) in self._conn.execute(
+                "SELECT key FROM kv WHERE namespace = ? AND expires_at < ?", (self.BLOBS, now)
+            )]
+            # Сначала файлы: запись удаляется, только когда файла уже нет
+            for key in expired:
+                self._remove_blob_file(key)
+            self._conn.execute("DELETE FROM kv WHERE expires_at < ?", (now,))
+            self._conn.commit()
+        if expired:
+            logger.info(f"Удалено истекших файлов общего хранилища: {len(expired)}")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisBackend(SharedStateBackend):
+    """
+    Хранилище на сервере с протоколом Redis (Redis, KeyDB, Valkey и т.п.).
+    Использует минимальный клиент протокола RESP без внешних зависимостей.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, prefix: str = "gene:", timeout: float = 5):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile('rb')
+        if self.password:
+            self._send(["AUTH", self.password])
+        if self.db:
+            self._send(["SELECT", str(self.db)])
+
+    def _disconnect(self):
+        try:
+            if self._reader is not None:
+                self._reader.close()
+            if self._sock is not None:
+                self._sock.close()
+        finally:
+            self._sock = None
+            self._reader = None
+
+    @staticmethod
+    def _encode(args: List) -> bytes:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            parts.append(f"${len(arg)}\r\n".encode())
+            parts.append(arg)
+            parts.append(b"\r\n")
+        return b"".join(parts)
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            # OSError: _command переподключится и повторит команду
+            raise ConnectionError("Соединение с Redis закрыто")
+
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b"+":
+            return payload.decode('utf-8')
+        if prefix == b"-":
+            raise SharedStateError(payload.decode('utf-8'))
+        if prefix == b":":
+            return int(payload)
+        if prefix == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if prefix == b"*":
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise SharedStateError(f"Неизвестный ответ Redis: {line!r}")
+
+    def _send(self, args: List):
+        self._sock.sendall(self._encode(args))
+        return self._read_reply()
+
+    def _command(self, *args):
+        with self._lock:
+            # Одна повторная попытка на случай разорванного соединения
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._send(list(args))
+                except (OSError, SharedStateError) as e:
+                    self._disconnect()
+                    if attempt == 1 or isinstance(e, SharedStateError):
+                        raise
+
+    def execute(self, *args):
+        """Выполняет команду Redis: для хранилищ, которые работают на том же сервере"""
+        return self._command(*args)
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}{namespace}:{key}"
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        value = self._command("GET", self._key(namespace, key))
+        if value is None:
+            return None
+        return json.loads(value.decode('utf-8'))
+
+    def set(self, namespace: str, key: str, value: dict, ttl: Optional[int] = None) -> None:
+        args = ["SET", self._key(namespace, key), json.dumps(value, ensure_ascii=False)]
+        if ttl:
+            args += ["EX", str(int(ttl))]
+        self._command(*args)
+
+    def set_if_absent(self, namespace: str, key: str, value: dict, ttl: Optional[int] = None) -> bool:
+        args = ["SET", self._key(namespace, key), json.dumps(value, ensure_ascii=False), "NX"]
+        if ttl:
+            args += ["EX", str(int(ttl))]
+        return self._command(*args) is not None
+
+    def delete(self, namespace: str, key: str) -> None:
+        self._command("DEL", self._key(namespace, key))
+
+    def put_blob(self, key: str, data: bytes, ttl: Optional[int] = None) -> None:
+        args = ["SET", self._key("blob", key), data]
+        if ttl:
+            args += ["EX", str(int(ttl))]
+        self._command(*args)
+
+    def get_blob(self, key: str) -> Optional[bytes]:
+        return self._command("GET", self._key("blob", key))
+
+    def close(self) -> None:
+        with self._lock:
+            self._disconnect()
+
+
+def create_backend(url: str = SHARED_STATE_URL) -> SharedStateBackend:
+    """Создает хранилище по адресу вида sqlite:///path или redis://host:port/db"""
+    parsed = urlparse(url)
+
+    if parsed.scheme in ("redis", "rediss"):
+        if parsed.scheme == "rediss":
+            raise SharedStateError("TLS-соединения с Redis не поддерживаются")
+        db = int(parsed.path.lstrip("/") or 0)
+        password = unquote(parsed.password) if parsed.password else None
+        return RedisBackend(parsed.hostname or "localhost", parsed.port or 6379, db, password)
+
+    if parsed.scheme in ("sqlite", "file", ""):
+        # sqlite:///relative/path -> relative/path, sqlite:////abs/path -> /abs/path
+        path = parsed.path[1:] if parsed.scheme else url
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return SQLiteBackend(path)
+
+    raise SharedStateError(f"Неподдерживаемый адрес хранилища: {url}")
+
+
+class SharedState:
+    """
+    Общее состояние реплик: кэш загрузок, индекс результатов и реестр задач.
+    Ошибки хранилища не прерывают работу приложения - они логируются,
+    а методы ведут себя так, будто записи нет.
+    """
+
+    UPLOADS = "uploads"
+    RESULTS = "results"
+    TASKS = "tasks"
+    CUSTOMERS = "customers"
+    SECRETS = "secrets"
+    JOBS = "jobs"
+
+    def __init__(self, backend: SharedStateBackend):
+        self.backend = backend
+        self._secrets = {}
+
+    def _get(self, namespace: str, key: str) -> Optional[dict]:
+        try:
+            return self.backend.get(namespace, key)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения общего состояния {namespace}/{key}: {e}")
+            return None
+
+    def _set(self, namespace: str, key: str, value: dict, ttl: Optional[int] = None) -> bool:
+        try:
+            self.backend.set(namespace, key, value, ttl)
+            return True
+        except Exception as e:
+            logger.warning(f"Ошибка записи общего состояния {namespace}/{key}: {e}")
+            return False
+
+    # Кэш загрузок: хэш содержимого -> URL на Freeimage.host
+
+    def get_upload(self, content_hash: str) -> Optional[dict]:
+        return self._get(self.UPLOADS, content_hash)
+
+    def put_upload(self, content_hash: str, url: str, name: str) -> None:
+        self._set(self.UPLOADS, content_hash, {
+            "url": url,
+            "name": name,
+            "uploaded_at": time.time()
+        }, UPLOAD_TTL)
+
+    # Индекс результатов: task_id -> сохраненное изображение
+
+    def get_result(self, task_id: str) -> Optional[dict]:
+        return self._get(self.RESULTS, task_id)
+
+    def put_result(self, task_id: str, filepath: str, image_url: str) -> None:
+        """Публикует скачанный результат, чтобы его могла отдать любая реплика"""
+        try:
+            with open(filepath, 'rb') as f:
+                self.backend.put_blob(f"result_{task_id}", f.read(), RESULT_TTL)
+        except Exception as e:
+            logger.warning(f"Не удалось опубликовать результат {task_id}: {e}")
+            return
+
+        self._set(self.RESULTS, task_id, {
+            "filename": os.path.basename(filepath),
+            "image_url": image_url,
+            "saved_at": time.time()
+        }, RESULT_TTL)
+
+    def load_result_file(self, task_id: str, folder: str) -> Optional[str]:
+        """
+        Возвращает локальный путь к результату задачи.
+        Если файла нет на этой реплике, он восстанавливается из общего хранилища.
+        """
+        meta = self.get_result(task_id)
+        if not meta:
+            return None
+
+        filepath = os.path.join(folder, meta["filename"])
+        if os.path.exists(filepath):
+            return filepath
+
+        try:
+            data = self.backend.get_blob(f"result_{task_id}")
+        except Exception as e:
+            logger.warning(f"Ошибка чтения результата {task_id}: {e}")
+            return None
+        if not data:
+            return None
+
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+        logger.info(f"Результат {task_id} восстановлен из общего хранилища: {filepath}")
+        return filepath
+
+    # Реестр задач
+
+    def register_task(self, task_id: str, customer_id: str, **fields) -> None:
+        now = time.time()
+        task = {
+            "task_id": task_id,
+            "customer_id": customer_id,
+            "status": "pending",
+            "created_at": now,
+            "updated_at": now
+        }
+        task.update(fields)
+        self._set(self.TASKS, task_id, task, TASK_TTL)
+        self._set(self.CUSTOMERS, customer_id, {"task_id": task_id}, TASK_TTL)
+
+    def update_task(self, task_id: str, **fields) -> None:
+        task = self.get_task(task_id)
+        if task is None:
+            return
+        task.update(fields)
+        task["updated_at"] = time.time()
+        self._set(self.TASKS, task_id, task, TASK_TTL)
+
+    def link_customer_task(self, customer_id: str, task_id: str) -> None:
+        """Привязывает к клиенту задачу, запущенную другим пользователем с тем же запросом"""
+        self._set(self.CUSTOMERS, customer_id, {"task_id": task_id}, TASK_TTL)
+
+    def get_task(self, task_id: str) -> Optional[dict]:
+        return self._get(self.TASKS, task_id)
+
+    def get_customer_task(self, customer_id: str) -> Optional[dict]:
+        """Последняя задача клиента, независимо от реплики, которая ее создала"""
+        ref = self._get(self.CUSTOMERS, customer_id)
+        if not ref:
+            return None
+        return self.get_task(ref["task_id"])
+
+    # Задания HTTP API: статус виден с любой реплики
+
+    def put_job(self, job_id: str, job: dict) -> None:
+        self._set(self.JOBS, job_id, job, JOB_TTL)
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        return self._get(self.JOBS, job_id)
+
+    # Общие секреты реплик
+
+    def get_secret(self, name: str) -> Optional[bytes]:
+        """
+        Случайный секрет, общий для всех реплик: создается при первом обращении.
+        Если его одновременно создают несколько реплик, записывается только одно значение,
+        а остальные читают его - поэтому после создания секрет не меняется и кэшируется.
+        None, если хранилище недоступно.
+        """
+        if name not in self._secrets:
+            try:
+                self.backend.set_if_absent(self.SECRETS, name, {"value": secrets.token_hex(32)})
+            except Exception as e:
+                logger.warning(f"Ошибка записи общего состояния {self.SECRETS}/{name}: {e}")
+            secret = self._get(self.SECRETS, name)
+            if secret is None:
+                return None
+            self._secrets[name] = bytes.fromhex(secret["value"])
+        return self._secrets[name]
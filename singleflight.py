@@ -0,0 +1,74 @@
+import logging
+import threading
+from typing import Any, Callable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """Выполняющийся вызов и его итог"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.interrupted = False
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные вызовы с одинаковым ключом: функцию выполняет
+    первый вызвавший, остальные ждут и получают тот же результат (или то же исключение).
+    Результаты не кэшируются - после завершения следующий вызов выполняется заново.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self, key: str) -> bool:
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key: str, fn: Callable, *args, **kwargs) -> Tuple[Any, bool]:
+        """
+        Выполняет fn(*args, **kwargs) или присоединяется к уже выполняющемуся вызову.
+        Возвращает (результат, shared), где shared=True, если результат получен от чужого вызова.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            logger.info(f"Присоединение к выполняющемуся запросу {key[:12]}")
+            call.done.wait()
+            if call.interrupted:
+                # Первый вызов прерван (например, остановкой его скрипта) - выполняем заново
+                return self.do(key, fn, *args, **kwargs)
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.interrupted = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            if call.waiters:
+                logger.info(f"Результат запроса {key[:12]} получили еще {call.waiters} ожидающих")
+
+        return call.result, False
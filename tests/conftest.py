@@ -0,0 +1,281 @@
+import io
+import os
+import random
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+# Модули приложения лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Настройки читаются при импорте приложения: хранилища тестов - во временном каталоге
+_workdir = tempfile.mkdtemp(prefix="gene_tests_")
+os.environ.setdefault("SHARED_STATE_URL", f"sqlite:///{_workdir}/state.sqlite3")
+os.environ.setdefault("HISTORY_DB_PATH", f"{_workdir}/history/history.sqlite3")
+
+
+class SessionState(dict):
+    """Замена st.session_state вне скрипта Streamlit: словарь с доступом через атрибуты"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+class StubExecutor:
+    """
+    Замена пула фоновых загрузок: задания выполняются в потоке теста - сразу
+    или (autorun=False) только при вызове run(), чтобы их можно было отменить
+    """
+
+    def __init__(self, max_workers=None, thread_name_prefix=""):
+        self.autorun = True
+        self.pending = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.pending.append((future, fn, args))
+        if self.autorun:
+            self.run()
+        return future
+
+    def run(self):
+        pending, self.pending = self.pending, []
+        for future, fn, args in pending:
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+
+class FakeUploadedFile(io.BytesIO):
+    """Объект с интерфейсом UploadedFile из st.file_uploader"""
+
+    def __init__(self, name: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+
+def _make_image(seed: int, size=(1280, 960), fmt: str = "JPEG", **save_args) -> bytes:
+    """Фото с полки: случайная сетка 8x8 цветов, растянутая до size"""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", (8, 8))
+    image.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(64)])
+    image = image.resize(size, Image.NEAREST)
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **save_args)
+    return buffer.getvalue()
+
+
+def _reencode(data: bytes, size=None, fmt: str = "JPEG", **save_args) -> bytes:
+    """Копия изображения: уменьшенная и/или пересохраненная в другом качестве или формате"""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    if size:
+        image = image.resize(size)
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **save_args)
+    return buffer.getvalue()
+
+
+class RespStub(socketserver.ThreadingTCPServer):
+    """
+    Локальная замена сервера Redis: понимает AUTH, SELECT, GET, MGET, SET (с NX и EX), DEL, INCR
+    и отсортированные множества с одинаковым весом (ZADD, ZCARD, ZREVRANGEBYLEX),
+    записывает полученные команды
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+        super().__init__(("127.0.0.1", 0), RespHandler)
+        self.password = password
+        self.data = {}
+        self.sets = {}
+        self.commands = []
+        self.connections = []
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def drop_connections(self):
+        """Разрывает открытые соединения, как при перезапуске сервера"""
+        with self.lock:
+            for connection in self.connections:
+                connection.shutdown(socket.SHUT_RDWR)
+            self.connections.clear()
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections.append(self.request)
+        self.authenticated = self.server.password is None
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line[:1] == b"*"
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def get(self, key):
+        value, expires_at = self.server.data.get(key, (None, None))
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return value
+
+    def reply_bulk(self, value):
+        if value is None:
+            self.wfile.write(b"$-1\r\n")
+        else:
+            self.wfile.write(b"$%d\r\n%s\r\n" % (len(value), value))
+
+    def handle(self):
+        while True:
+            try:
+                args = self.read_command()
+            except OSError:
+                return
+            if args is None:
+                return
+            name = args[0].decode().upper()
+            self.server.commands.append([name] + args[1:])
+
+            if name == "AUTH":
+                self.authenticated = args[1].decode() == self.server.password
+                self.wfile.write(b"+OK\r\n" if self.authenticated else b"-WRONGPASS invalid password\r\n")
+            elif not self.authenticated:
+                self.wfile.write(b"-NOAUTH Authentication required.\r\n")
+            elif name == "SELECT":
+                self.wfile.write(b"+OK\r\n")
+            elif name == "GET":
+                self.reply_bulk(self.get(args[1]))
+            elif name == "MGET":
+                self.wfile.write(b"*%d\r\n" % (len(args) - 1))
+                for key in args[1:]:
+                    self.reply_bulk(self.get(key))
+            elif name == "SET":
+                options = [arg.upper() for arg in args[3:]]
+                expires_at = None
+                if b"EX" in options:
+                    expires_at = time.time() + int(options[options.index(b"EX") + 1])
+                with self.server.lock:
+                    if b"NX" in options and self.get(args[1]) is not None:
+                        self.reply_bulk(None)
+                        continue
+                    self.server.data[args[1]] = (args[2], expires_at)
+                self.wfile.write(b"+OK\r\n")
+            elif name == "INCR":
+                with self.server.lock:
+                    value = int(self.get(args[1]) or 0) + 1
+                    self.server.data[args[1]] = (b"%d" % value, None)
+                self.wfile.write(b":%d\r\n" % value)
+            elif name == "ZADD":
+                members = self.server.sets.setdefault(args[1], set())
+                added = args[3] not in members
+                members.add(args[3])
+                self.wfile.write(b":%d\r\n" % added)
+            elif name == "ZCARD":
+                self.wfile.write(b":%d\r\n" % len(self.server.sets.get(args[1], ())))
+            elif name == "ZREVRANGEBYLEX":
+                members = sorted(self.server.sets.get(args[1], ()), reverse=True)
+                upper = args[2]
+                if upper.startswith(b"("):
+                    members = [m for m in members if m < upper[1:]]
+                elif upper.startswith(b"["):
+                    members = [m for m in members if m <= upper[1:]]
+                if len(args) == 7:
+                    offset, count = int(args[5]), int(args[6])
+                    members = members[offset:offset + count]
+                self.wfile.write(b"*%d\r\n" % len(members))
+                for member in members:
+                    self.reply_bulk(member)
+            elif name == "DEL":
+                removed = self.server.data.pop(args[1], None) is not None
+                self.wfile.write(b":%d\r\n" % removed)
+            else:
+                self.wfile.write(b"-ERR unknown command '%s'\r\n" % args[0])
+
+
+@pytest.fixture
+def stub():
+    server = RespStub(password="secret")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_image():
+    return _make_image
+
+
+@pytest.fixture
+def reencode():
+    return _reencode
+
+
+@pytest.fixture
+def uploaded_file():
+    return FakeUploadedFile
+
+
+@pytest.fixture
+def session_state(monkeypatch):
+    """Пустой st.session_state для вызова функций приложения вне скрипта"""
+    import streamlit
+
+    state = SessionState()
+    monkeypatch.setattr(streamlit, "session_state", state)
+    return state
+
+
+@pytest.fixture
+def shared_state(tmp_path, monkeypatch):
+    """Отдельное общее хранилище теста вместо кэшированного get_shared_state приложения"""
+    import app
+    from shared_state import SharedState, SQLiteBackend
+
+    state = SharedState(SQLiteBackend(str(tmp_path / "state.sqlite3")))
+    monkeypatch.setattr(app, "get_shared_state", lambda: state)
+    yield state
+    state.backend.close()
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """Общий пул фоновых загрузок приложения на StubExecutor; возвращает его исполнитель"""
+    import upload_pipeline
+
+    monkeypatch.setattr(upload_pipeline, "ThreadPoolExecutor", StubExecutor)
+    monkeypatch.setattr(upload_pipeline, "_pipeline", None)
+    return upload_pipeline.get_pipeline().executor
@@ -0,0 +1,232 @@
+import http.client
+import json
+import threading
+import time
+import uuid
+
+import pytest
+
+import api_server
+import app
+from api_server import JobRunner, RequestError, create_server, parse_job_request, parse_multipart
+from loadtest import MockBackends
+
+
+def encode_multipart(fields=(), files=()):
+    """Тело multipart/form-data и его Content-Type; значения полей - str или bytes"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields:
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode()
+                     + value + b"\r\n")
+    for filename, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="images"; '
+                     f'filename="{filename}"\r\nContent-Type: image/jpeg\r\n\r\n'.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def test_parse_multipart_fields_and_files(make_image):
+    photo = make_image(0)
+    body, content_type = encode_multipart([("prompt", "полка с товаром"), ("toggles", "a,b")],
+                                          [("a.jpg", photo), ("b.jpg", b"\x00\r\n--")])
+
+    fields, files = parse_multipart(content_type, body)
+
+    assert fields == {"prompt": "полка с товаром", "toggles": "a,b"}
+    assert files == [("a.jpg", photo), ("b.jpg", b"\x00\r\n--")]
+
+
+def test_parse_multipart_rejects_non_utf8_field():
+    body, content_type = encode_multipart([("prompt", "полка".encode("cp1251"))])
+
+    with pytest.raises(RequestError) as error:
+        parse_multipart(content_type, body)
+    assert (error.value.status, error.value.error) == (400, "invalid_field_encoding")
+
+
+def test_parse_multipart_rejects_plain_body():
+    with pytest.raises(RequestError) as error:
+        parse_multipart("text/plain", b"prompt=x")
+    assert (error.value.status, error.value.error) == (400, "invalid_multipart")
+
+
+@pytest.mark.parametrize("fields, files, status, code", [
+    ({}, [], 400, "REFERENCES_URLS_IS_EMPTY"),
+    ({}, [("a.jpg", b"jpeg")] * 11, 400, "too_many_images"),
+    ({}, [("a.jpg", b"not an image")], 400, "invalid_image"),
+    ({"toggles": "нет такого"}, None, 400, "unknown_toggles"),
+    ({"customer_id": "../abc"}, None, 400, "CUSTOMER_ID_NOT_VALID"),
+])
+def test_parse_job_request_validation(make_image, fields, files, status, code):
+    with pytest.raises(RequestError) as error:
+        parse_job_request(fields, files if files is not None else [("a.jpg", make_image(0))])
+    assert (error.value.status, error.value.error) == (status, code)
+
+
+def test_parse_job_request_defaults(make_image):
+    toggle = next(iter(app.TOGGLE_TEXTS))
+    request = parse_job_request({"prompt": "полка", "toggles": f" {toggle} ,"}, [("a.jpg", make_image(0))])
+
+    assert request["prompt"] == "полка"
+    assert request["toggles"][toggle] is True
+    assert sum(request["toggles"].values()) == 1
+    assert request["customer_id"].isalnum()
+
+
+def test_queued_job_is_a_copy(monkeypatch):
+    """Обработчик меняет свою копию задания: ответ 202 показывает статус на момент приема"""
+    processed = threading.Event()
+
+    def process_job(generator, job, request):
+        api_server.update_job(job, status="uploading")
+        processed.set()
+
+    monkeypatch.setattr(api_server, "process_job", process_job)
+    runner = JobRunner(workers=1, queue_size=1)
+    runner.start()
+    job = {"job_id": uuid.uuid4().hex, "status": "queued", "created_at": time.time()}
+
+    assert runner.submit(job, {})
+    assert processed.wait(5)
+    assert job["status"] == "queued"
+    assert app.get_shared_state().get_job(job["job_id"])["status"] == "uploading"
+
+
+@pytest.fixture(scope="module")
+def backends():
+    backends = MockBackends(gen_latency=0.3, upload_latency=0)
+    backends.start()
+    yield backends
+    backends.stop()
+
+
+@pytest.fixture
+def server_factory(backends, monkeypatch, tmp_path):
+    """Запускает HTTP API против mock-сервисов; возвращает функцию запроса к нему"""
+    monkeypatch.setattr(app, "API_URL_GEN_IMAGE", f"{backends.base_url}/generations")
+    monkeypatch.setattr(app, "API_URL_QUERY_IMAGE", f"{backends.base_url}/generations/")
+    monkeypatch.setattr(app, "FREEIMAGE_API_URL", f"{backends.base_url}/upload")
+    monkeypatch.setattr(app, "POLL_WAIT_TIME", 0.05)
+    monkeypatch.setattr(app, "POLL_MAX_ATTEMPTS", 100)
+    monkeypatch.setattr(app, "IMAGES_FOLDER", str(tmp_path))
+    monkeypatch.setattr(api_server, "IMAGES_FOLDER", str(tmp_path))
+    servers = []
+
+    def start(workers=2, queue_size=4):
+        server, runner = create_server("127.0.0.1", 0, workers, queue_size)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+        def request(method, path, body=None, headers=None):
+            connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            data = response.read()
+            connection.close()
+            if response.getheader("Content-Type", "").startswith("application/json"):
+                data = json.loads(data)
+            return response, data
+
+        request.runner = runner
+        return request
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def post_job(request, fields, files):
+    body, content_type = encode_multipart(fields, files)
+    return request("POST", "/v1/jobs", body, {"Content-Type": content_type})
+
+
+def wait_for_job(request, job_id, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        _, job = request("GET", f"/v1/jobs/{job_id}")
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"задание {job_id} не завершилось: {job['status']}")
+
+
+def test_job_lifecycle(server_factory, make_image, reencode):
+    request = server_factory()
+    photo = make_image(0)
+
+    response, job = post_job(request, [("prompt", "полка"), ("customer_id", "abc123")],
+                             [("a.jpg", photo), ("a_small.jpg", reencode(photo, size=(640, 480)))])
+
+    assert response.status == 202
+    assert job["status"] == "queued"
+    assert response.getheader("Location") == job["status_url"] == f"/v1/jobs/{job['job_id']}"
+
+    job = wait_for_job(request, job["job_id"])
+    assert job["status"] == "succeeded"
+    assert job["customer_id"] == "abc123"
+    assert job["result_url"] == f"/v1/jobs/{job['job_id']}/result"
+
+    response, data = request("GET", job["result_url"])
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "image/jpeg"
+    assert data[:2] == b"\xff\xd8"
+
+
+def test_result_is_not_ready_while_running(server_factory, make_image):
+    request = server_factory()
+    _, job = post_job(request, [], [("a.jpg", make_image(1))])
+
+    response, data = request("GET", f"/v1/jobs/{job['job_id']}/result")
+
+    assert response.status == 409
+    assert data["error"] == "not_ready"
+    wait_for_job(request, job["job_id"])
+
+
+@pytest.mark.parametrize("path, code", [
+    ("/v1/jobs/missing", "job_not_found"),
+    ("/v1/jobs/missing/result", "job_not_found"),
+    ("/v1/other", "not_found"),
+])
+def test_unknown_paths(server_factory, path, code):
+    response, data = server_factory()("GET", path)
+
+    assert response.status == 404
+    assert data["error"] == code
+
+
+def test_invalid_requests(server_factory, make_image):
+    request = server_factory()
+
+    response, data = post_job(request, [("prompt", "полка".encode("cp1251"))], [("a.jpg", make_image(0))])
+    assert (response.status, data["error"]) == (400, "invalid_field_encoding")
+
+    response, data = post_job(request, [], [("a.jpg", b"not an image")])
+    assert (response.status, data["error"]) == (400, "invalid_image")
+
+    response, data = request("POST", "/v1/jobs", b"{}", {"Content-Type": "application/json"})
+    assert (response.status, data["error"]) == (415, "unsupported_media_type")
+
+    response, data = request("POST", "/v1/jobs", b"", {"Content-Length": "-1"})
+    assert (response.status, data["error"]) == (400, "invalid_content_length")
+
+
+def test_full_queue_returns_429(server_factory, make_image):
+    # Без обработчиков задания остаются в очереди
+    request = server_factory(workers=0, queue_size=1)
+    files = [("a.jpg", make_image(0))]
+
+    response, job = post_job(request, [], files)
+    assert response.status == 202
+
+    response, data = post_job(request, [], files)
+    assert response.status == 429
+    assert data["error"] == "queue_full"
+    assert response.getheader("Retry-After") == str(api_server.API_RETRY_AFTER)
+
+    _, health = request("GET", "/healthz")
+    assert (health["queued"], health["queue_size"], health["active"]) == (1, 1, 0)
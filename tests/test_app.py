@@ -0,0 +1,178 @@
+import itertools
+
+import pytest
+
+import app
+import upload_pipeline
+
+
+@pytest.fixture
+def uploads(monkeypatch, pipeline):
+    """
+    Загрузка на Freeimage.host без сети (фоновые загрузки выполняются сразу):
+    записывает вызовы, неудачна для файлов из failing
+    """
+    calls = []
+    failing = set()
+    counter = itertools.count()
+
+    def upload(self, image_bytes, filename=None):
+        calls.append(image_bytes)
+        if image_bytes in failing:
+            return None
+        return f"https://img.example/{next(counter)}.jpg"
+
+    monkeypatch.setattr(app.FreeImageUploader, "upload_image", upload)
+    monkeypatch.setattr(app.FreeImageUploader, "verify_image_url", lambda self, url: True)
+    upload.calls = calls
+    upload.failing = failing
+    return upload
+
+
+def settled(images):
+    """Переносит итоги фоновых загрузок в описания изображений"""
+    for img in images:
+        upload_pipeline.settle(img, wait=True)
+    return images
+
+
+def test_near_duplicates_share_original_url(session_state, shared_state, uploads,
+                                            make_image, reencode, uploaded_file):
+    photo = make_image(0)
+    files = [
+        uploaded_file("a.jpg", photo),
+        uploaded_file("b.jpg", make_image(1)),
+        uploaded_file("a_small.jpg", reencode(photo, size=(640, 480))),
+        uploaded_file("a_smaller.png", reencode(photo, size=(320, 240), fmt="PNG")),
+    ]
+
+    images = settled(app.process_uploaded_files(files))
+
+    assert [img["duplicate_of"] for img in images] == [None, None, "a.jpg", "a.jpg"]
+    assert images[2]["url"] == images[3]["url"] == images[0]["url"]
+    assert len(uploads.calls) == 2
+
+
+def test_duplicate_of_earlier_selection(session_state, shared_state, uploads,
+                                        make_image, reencode, uploaded_file):
+    photo = make_image(0)
+    app.process_uploaded_files([uploaded_file("a.jpg", photo)])
+
+    images = app.process_uploaded_files([
+        uploaded_file("a.jpg", photo),
+        uploaded_file("a_copy.jpg", reencode(photo, quality=40)),
+    ])
+
+    assert images[1]["duplicate_of"] == "a.jpg"
+    assert len(uploads.calls) == 1
+
+
+def test_failed_background_upload_keeps_file(session_state, shared_state, uploads,
+                                             make_image, reencode, uploaded_file):
+    """Неудачная фоновая загрузка не убирает файл из выбора: его загрузят при генерации"""
+    photo = make_image(0)
+    uploads.failing.add(photo)
+
+    images = settled(app.process_uploaded_files([
+        uploaded_file("a.jpg", photo),
+        uploaded_file("a_copy.jpg", reencode(photo, quality=40)),
+    ]))
+
+    assert [(img["name"], img["duplicate_of"]) for img in images] == [("a.jpg", None), ("a_copy.jpg", "a.jpg")]
+    assert [(img["url"], img["verified"]) for img in images] == [(None, False), (None, False)]
+    assert len(uploads.calls) == 1
+
+
+def test_near_duplicates_are_not_reused_across_sessions(session_state, shared_state, uploads,
+                                                        make_image, reencode, uploaded_file):
+    """Общий кэш загрузок совпадает только по точному содержимому"""
+    photo = make_image(0)
+    app.process_uploaded_files([uploaded_file("a.jpg", photo)])
+
+    # Другая сессия: тот же файл берется из общего кэша, похожий загружается заново
+    session_state.clear()
+    images = settled(app.process_uploaded_files([
+        uploaded_file("mine.jpg", photo),
+        uploaded_file("other.jpg", reencode(photo, quality=40)),
+    ]))
+
+    assert images[0]["url"] == "https://img.example/0.jpg"
+    assert images[1]["duplicate_of"] == "mine.jpg"
+    session_state.clear()
+    images = settled(app.process_uploaded_files([uploaded_file("other.jpg", reencode(photo, quality=40))]))
+
+    assert images[0]["url"] == "https://img.example/1.jpg"
+    assert len(uploads.calls) == 2
+
+
+class StubHttp:
+    """Клиент внешних сервисов: отвечает заданным кодом и типом содержимого или выбрасывает ошибку"""
+
+    def __init__(self, outcome):
+        self.outcome = outcome
+
+    def request(self, endpoint, method, url, **kwargs):
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        status, content_type = self.outcome
+        response = app.requests.Response()
+        response.status_code = status
+        response.headers["Content-Type"] = content_type
+        return response
+
+
+@pytest.mark.parametrize("outcome, expected", [
+    ((200, "image/jpeg"), True),
+    ((200, "text/html"), False),
+    ((404, "text/html"), False),
+    (app.resilience.CircuitOpenError("freeimage.verify", 10), None),
+])
+def test_verify_image_url_is_tri_state(outcome, expected):
+    uploader = app.FreeImageUploader()
+    uploader.http = StubHttp(outcome)
+
+    assert uploader.verify_image_url("https://img.example/0.jpg") is expected
+
+
+def test_unverified_urls_are_kept():
+    """Пропущенная проверка не отбрасывает ссылку: ее проверит сервис генерации"""
+    uploader = app.FreeImageUploader()
+    uploader.http = StubHttp(app.resilience.CircuitOpenError("freeimage.verify", 10))
+
+    assert uploader.verify_image_urls(["https://img.example/0.jpg"]) == ["https://img.example/0.jpg"]
+
+
+@pytest.fixture
+def query_params(monkeypatch):
+    """Параметры адреса страницы вне браузера: значения - списки, как в Streamlit"""
+    params = {}
+
+    def set_query_params(**new):
+        params.clear()
+        params.update({key: value if isinstance(value, list) else [value] for key, value in new.items()})
+
+    monkeypatch.setattr(app.st, "experimental_get_query_params", lambda: dict(params))
+    monkeypatch.setattr(app.st, "experimental_set_query_params", set_query_params)
+    return params
+
+
+def test_signed_customer_id_roundtrip(shared_state, query_params):
+    app.set_customer_query_param("abc123")
+
+    assert query_params["cid"][0].startswith("abc123.")
+    assert app.customer_id_from_query_params() == "abc123"
+
+
+@pytest.mark.parametrize("cid", ["abc123", "abc123.", "abc123.0123456789abcdef0123456789abcdef",
+                                 "abc123.подпись", "../etc.x"])
+def test_unsigned_or_forged_customer_id_is_rejected(shared_state, query_params, cid):
+    query_params["cid"] = [cid]
+
+    assert app.customer_id_from_query_params() is None
+
+
+def test_signature_does_not_transfer_between_customers(shared_state, query_params):
+    signature = app.customer_id_signature("abc123")
+    query_params["cid"] = [f"abc124.{signature}"]
+
+    assert app.customer_id_from_query_params() is None
@@ -0,0 +1,119 @@
+import pytest
+
+from history import RedisHistory, SQLiteHistory, create_history
+from shared_state import SQLiteBackend, create_backend
+
+
+@pytest.fixture
+def result_file(tmp_path, make_image):
+    path = tmp_path / "result.jpg"
+    path.write_bytes(make_image(0))
+    return str(path)
+
+
+@pytest.fixture
+def redis_backend(stub):
+    backend = create_backend(f"redis://:secret@127.0.0.1:{stub.port}/0")
+    yield backend
+    backend.close()
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def history(request, tmp_path):
+    if request.param == "sqlite":
+        backend = SQLiteBackend(str(tmp_path / "state.sqlite3"))
+    else:
+        backend = request.getfixturevalue("redis_backend")
+    history = create_history(backend, str(tmp_path / "history" / "history.sqlite3"))
+    yield history
+    history.close()
+    backend.close()
+
+
+def add(history, customer_id, task_id, created_at, filepath):
+    return history.add(customer_id, task_id, f"промпт {task_id}", {"bright": True}, ["hash"],
+                       filepath, f"https://img.example/{task_id}.jpg", created_at=created_at)
+
+
+def test_history_follows_shared_state_backend(tmp_path, redis_backend):
+    path = str(tmp_path / "history" / "history.sqlite3")
+
+    assert isinstance(create_history(SQLiteBackend(str(tmp_path / "state.sqlite3")), path), SQLiteHistory)
+    assert isinstance(create_history(redis_backend, path), RedisHistory)
+
+
+def test_pages_go_from_newest_to_oldest(history, result_file):
+    for i in range(7):
+        add(history, "alice", f"t{i}", 1000.0 + i, result_file)
+    add(history, "bob", "t_bob", 2000.0, result_file)
+
+    pages, cursor = [], None
+    while True:
+        entries, cursor = history.page("alice", 3, cursor)
+        pages.append([entry["task_id"] for entry in entries])
+        if cursor is None:
+            break
+
+    assert pages == [["t6", "t5", "t4"], ["t3", "t2", "t1"], ["t0"]]
+    assert history.count("alice") == 7
+    assert history.count("bob") == 1
+
+
+def test_equal_timestamps_are_paged_by_id(history, result_file):
+    """Курсор (created_at, id) не теряет и не повторяет записи с одинаковым временем"""
+    for i in range(5):
+        add(history, "alice", f"t{i}", 1000.0, result_file)
+
+    first, cursor = history.page("alice", 2)
+    second, cursor = history.page("alice", 2, cursor)
+    third, cursor = history.page("alice", 2, cursor)
+
+    seen = [entry["task_id"] for entry in first + second + third]
+    assert seen == ["t4", "t3", "t2", "t1", "t0"]
+    assert cursor is None
+
+
+def test_last_full_page_has_no_next_cursor(history, result_file):
+    for i in range(4):
+        add(history, "alice", f"t{i}", 1000.0 + i, result_file)
+
+    entries, cursor = history.page("alice", 2, history.page("alice", 2)[1])
+
+    assert [entry["task_id"] for entry in entries] == ["t1", "t0"]
+    assert cursor is None
+
+
+def test_entry_fields_roundtrip(history, result_file):
+    entry_id = history.add("alice", "t1", "полка", {"bright": True}, ["h1", "h2"], result_file,
+                           "https://img.example/t1.jpg", created_at=1000.0, durations={"wait": 1.5})
+
+    [entry], _ = history.page("alice", 10)
+
+    assert entry["id"] == entry_id
+    assert entry["prompt"] == "полка"
+    assert entry["toggles"] == {"bright": True}
+    assert entry["reference_hashes"] == ["h1", "h2"]
+    assert entry["durations"] == {"wait": 1.5}
+    assert entry["created_at"] == 1000.0
+    assert history.load_thumbnail(entry)
+
+
+def test_same_task_is_recorded_once_per_customer(history, result_file):
+    assert add(history, "alice", "t1", 1000.0, result_file) is not None
+    assert add(history, "alice", "t1", 1001.0, result_file) is None
+    assert add(history, "bob", "t1", 1000.0, result_file) is not None
+
+    assert history.count("alice") == 1
+
+
+def test_redis_thumbnail_is_available_on_another_machine(tmp_path, redis_backend, result_file):
+    writer = RedisHistory(redis_backend, str(tmp_path / "machine_a"))
+    reader = RedisHistory(redis_backend, str(tmp_path / "machine_b"))
+    add(writer, "alice", "t1", 1000.0, result_file)
+
+    [entry], _ = reader.page("alice", 10)
+    thumbnail = reader.load_thumbnail(entry)
+
+    assert thumbnail.startswith(str(tmp_path / "machine_b"))
+    with open(thumbnail, "rb") as cached, open(entry["thumbnail"], "rb") as original:
+        assert cached.read() == original.read()
@@ -0,0 +1,81 @@
+import pytest
+
+from image_dedup import DEDUP_MAX_DISTANCE, find_duplicates, hamming_distances, perceptual_hashes
+
+
+@pytest.fixture
+def photos(make_image):
+    return [make_image(seed) for seed in range(3)]
+
+
+def test_resized_and_reencoded_copies_match(photos, reencode):
+    original = photos[0]
+    copies = [
+        reencode(original, size=(640, 480)),
+        reencode(original, quality=40),
+        reencode(original, size=(320, 240), fmt="PNG"),
+    ]
+    hashes = perceptual_hashes([original] + copies)
+
+    distances = hamming_distances(hashes[:1], hashes[1:])[0]
+    assert all(distance <= DEDUP_MAX_DISTANCE for distance in distances)
+    assert find_duplicates(hashes[1:], hashes[:1]) == [0, 0, 0]
+
+
+def test_distinct_images_do_not_match(photos):
+    hashes = perceptual_hashes(photos)
+
+    distances = hamming_distances(hashes, hashes)
+    assert all(distances[i][j] > DEDUP_MAX_DISTANCE for i in range(3) for j in range(3) if i != j)
+    assert find_duplicates(hashes, []) == [None, None, None]
+
+
+def test_undecodable_bytes_have_no_hash(photos):
+    hashes = perceptual_hashes([b"not an image", photos[0]])
+
+    assert hashes[0] is None
+    assert len(hashes[1]) == 16
+    assert find_duplicates(hashes, []) == [None, None]
+
+
+def test_known_images_come_first_in_indices(photos, reencode):
+    known = perceptual_hashes(photos)
+    new = perceptual_hashes([reencode(photos[2], size=(640, 480)), reencode(photos[0], quality=40)])
+
+    assert find_duplicates(new, known) == [2, 0]
+
+
+def test_batch_match_points_to_earlier_image_only(photos, reencode):
+    """Первое изображение пачки не считается дубликатом более позднего"""
+    known = perceptual_hashes(photos[1:])
+    new = perceptual_hashes([photos[0], reencode(photos[0], size=(640, 480))])
+
+    # Индекс n_known + j указывает на изображение j этой пачки
+    assert find_duplicates(new, known) == [None, len(known) + 0]
+
+
+def test_batch_indices_skip_undecodable_images(photos, reencode):
+    """Индексы пачки - позиции в new_hashes, а не среди изображений с хэшем"""
+    new = perceptual_hashes([b"broken", photos[0], b"broken", reencode(photos[0], quality=40)])
+
+    assert find_duplicates(new, []) == [None, None, None, 1]
+
+
+def test_batch_chain_of_copies(photos, reencode):
+    """Каждая следующая копия совпадает с одной из более ранних, ни одна - с более поздней"""
+    first = reencode(photos[0], size=(960, 720))
+    second = reencode(first, size=(640, 480), quality=60)
+    third = reencode(second, size=(320, 240), fmt="PNG")
+    matches = find_duplicates(perceptual_hashes([photos[0], first, second, third]), [])
+
+    assert matches[0] is None
+    assert all(match is not None and match < i for i, match in enumerate(matches) if i)
+
+
+def test_nearest_candidate_wins():
+    known = ["0000000000000000", "0000000000000007"]
+    new = ["000000000000000f"]
+
+    # Расстояния 4 и 1: выбирается ближайший
+    assert find_duplicates(new, known) == [1]
+    assert find_duplicates(new, known, max_distance=0) == [None]
@@ -0,0 +1,165 @@
+import pytest
+
+import app
+import reference_transport
+import upload_pipeline
+from reference_transport import UrlTransport, encoded_size, split_references
+
+
+@pytest.fixture
+def inline(monkeypatch):
+    """Встроенные референсы включены: до 2 КБ на файл, до 4 КБ base64 на запрос"""
+    monkeypatch.setattr(reference_transport, "INLINE_REFERENCES", True)
+    monkeypatch.setattr(reference_transport, "INLINE_MAX_IMAGE_KB", 2)
+    monkeypatch.setattr(reference_transport, "INLINE_MAX_TOTAL_KB", 4)
+
+
+def ref(name, size):
+    return {"name": name, "bytes": b"x" * size, "content_hash": name, "url": None}
+
+
+def names(references):
+    return [reference["name"] for reference in references]
+
+
+def test_encoded_size_matches_base64():
+    import base64
+
+    for size in range(10):
+        assert encoded_size(size) == len(base64.b64encode(b"x" * size))
+
+
+def test_everything_goes_by_url_when_disabled():
+    references = [ref("a", 10), ref("b", 20)]
+
+    assert split_references(references) == ([], references)
+
+
+def test_smallest_images_are_inlined_first(inline):
+    references = [ref("big", 1500), ref("small", 100), ref("mid", 900)]
+
+    inlined, by_url = split_references(references)
+
+    # base64: 136 + 1200 + 2000 байт - все в лимите 4096
+    assert names(inlined) == ["small", "mid", "big"]
+    assert by_url == []
+
+
+def test_budget_counts_base64_size(inline):
+    """Три файла по 1200 байт занимают 3600 байт, но в запросе - 4800 и в лимит 4096 не входят"""
+    inlined, by_url = split_references([ref("a", 1200), ref("b", 1200), ref("c", 1200)])
+
+    assert names(inlined) == ["a", "b"]
+    assert names(by_url) == ["c"]
+
+
+def test_large_file_goes_by_url(inline):
+    inlined, by_url = split_references([ref("huge", 2049), ref("a", 10)])
+
+    assert names(inlined) == ["a"]
+    assert names(by_url) == ["huge"]
+
+
+class StubUploader:
+    """Проверка ссылок: доступны все, кроме перечисленных в broken; для unchecked проверка пропущена"""
+
+    def __init__(self, broken=(), unchecked=()):
+        self.broken = set(broken)
+        self.unchecked = set(unchecked)
+        self.checked = []
+
+    def verify_image_url(self, url):
+        self.checked.append(url)
+        if url in self.unchecked:
+            return None
+        return url not in self.broken
+
+
+def test_url_transport_uploads_through_callable():
+    uploads = []
+
+    def upload(reference):
+        uploads.append(reference["name"])
+        return f"https://img.example/{reference['name']}.jpg"
+
+    transport = UrlTransport(StubUploader(broken={"https://img.example/c.jpg"}), upload)
+    references = [ref("a", 10), dict(ref("b", 10), url="https://img.example/b0.jpg"), ref("c", 10)]
+
+    assert transport.encode(references) == ["https://img.example/a.jpg", "https://img.example/b0.jpg", None]
+    assert uploads == ["a", "c"]
+    # Ссылка запоминается: повторная передача не загружает изображение снова
+    transport.encode(references)
+    assert uploads == ["a", "c"]
+
+
+def test_skipped_verification_is_not_cached(pipeline):
+    """Ссылка с пропущенной проверкой передается, но при следующей генерации проверяется снова"""
+    uploader = StubUploader(unchecked={"https://img.example/a.jpg"})
+    transport = UrlTransport(uploader, lambda reference: None)
+    reference = dict(ref("a", 10), url="https://img.example/a.jpg")
+
+    assert transport.encode([reference]) == ["https://img.example/a.jpg"]
+    assert reference["verified"] is None
+    uploader.unchecked.clear()
+    transport.encode([reference])
+    transport.encode([reference])
+    assert uploader.checked == ["https://img.example/a.jpg"] * 2
+
+
+def test_url_transport_joins_background_upload(pipeline):
+    """Генерация дожидается фоновой загрузки и использует ее результат, не загружая заново"""
+    pipeline.autorun = False
+    reference = dict(ref("a", 10), upload=upload_pipeline.get_pipeline().submit(
+        lambda: ("https://img.example/bg.jpg", True)))
+    uploader = StubUploader()
+    transport = UrlTransport(uploader, lambda reference: pytest.fail("загрузка повторена"))
+
+    pipeline.run()
+    assert transport.encode([reference]) == ["https://img.example/bg.jpg"]
+    assert reference["upload"] is None
+    # Ссылка уже проверена в фоне
+    assert uploader.checked == []
+
+
+class StubTransport:
+    def __init__(self, name, unavailable=()):
+        self.name = name
+        self.unavailable = set(unavailable)
+
+    def encode(self, references):
+        return [None if r["name"] in self.unavailable else f"{self.name}:{r['name']}" for r in references]
+
+
+def test_encode_references_keeps_original_order(inline):
+    generator = app.ImageGenerator()
+    generator.inline_transport = StubTransport("inline")
+    generator.url_transport = StubTransport("url", unavailable={"broken"})
+    references = [ref("big", 3000), ref("small", 10), ref("broken", 2500), ref("mid", 500)]
+
+    assert generator.encode_references(references) == ["url:big", "inline:small", "inline:mid"]
+
+
+def test_overflow_is_uploaded_through_shared_cache(inline, monkeypatch, session_state, shared_state, pipeline,
+                                                   uploaded_file, make_image):
+    """Изображения сверх лимита загружаются в фоне при выборе файлов и попадают в общий кэш загрузок"""
+    uploads = []
+
+    def upload_image(self, image_bytes, filename=None):
+        uploads.append(image_bytes)
+        return f"https://img.example/{len(uploads)}.jpg"
+
+    monkeypatch.setattr(app.FreeImageUploader, "upload_image", upload_image)
+    monkeypatch.setattr(app.FreeImageUploader, "verify_image_url", lambda self, url: True)
+    monkeypatch.setattr(reference_transport, "INLINE_MAX_IMAGE_KB", 64)
+    photos = [make_image(seed, size=(64, 64), quality=95) for seed in range(3)]
+    monkeypatch.setattr(reference_transport, "INLINE_MAX_TOTAL_KB",
+                        sum(encoded_size(len(photo)) for photo in sorted(photos, key=len)[:2]) / 1024)
+
+    images = app.process_uploaded_files([uploaded_file(f"{i}.jpg", photo) for i, photo in enumerate(photos)])
+    for img in images:
+        upload_pipeline.settle(img, wait=True)
+
+    largest = max(images, key=lambda img: len(img["bytes"]))
+    assert uploads == [largest["bytes"]]
+    assert [img["url"] for img in images if img is not largest] == [None, None]
+    assert shared_state.get_upload(largest["content_hash"])["url"] == largest["url"]
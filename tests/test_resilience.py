@@ -0,0 +1,155 @@
+import pytest
+import requests
+
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, EndpointConfig, ResilientClient, RetryBudget
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемое время для автомата отключения"""
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "time", lambda: now[0])
+    return now
+
+
+def make_breaker(threshold=3, reset_timeout=30):
+    config = EndpointConfig(initial_timeout=5, min_timeout=1, max_timeout=5,
+                            failure_threshold=threshold, reset_timeout=reset_timeout)
+    return CircuitBreaker("test", config)
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = make_breaker(threshold=3)
+    for _ in range(2):
+        breaker.before_request()
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.before_request()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request()
+    assert error.value.endpoint == "test"
+    assert error.value.retry_in == 30
+
+
+def test_success_resets_failure_count(clock):
+    breaker = make_breaker(threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_allows_single_probe(clock):
+    breaker = make_breaker(threshold=1, reset_timeout=30)
+    breaker.record_failure()
+
+    clock[0] += 31
+    breaker.before_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_request()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = make_breaker(threshold=5, reset_timeout=30)
+    for _ in range(5):
+        breaker.record_failure()
+
+    clock[0] += 31
+    breaker.before_request()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.retry_in() == 30
+
+
+class FakeSession:
+    """Отвечает заданными кодами и считает запросы"""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.requests = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.requests.append((method, url, timeout))
+        status = self.statuses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        response = requests.Response()
+        response.status_code = status
+        return response
+
+
+def make_client(session, threshold=5, max_retries=2):
+    config = EndpointConfig(initial_timeout=5, min_timeout=1, max_timeout=5,
+                            failure_threshold=threshold, max_retries=max_retries, timeout_per_mb=2)
+    client = ResilientClient({"test": config}, RetryBudget(max_tokens=10))
+    client.session = session
+    return client
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(resilience.time, "sleep", lambda seconds: None)
+
+
+def test_idempotent_request_is_retried(no_sleep):
+    session = FakeSession(503, 200)
+    response = make_client(session).request("test", "GET", "http://service/")
+
+    assert response.status_code == 200
+    assert len(session.requests) == 2
+
+
+def test_non_idempotent_request_is_not_retried(no_sleep):
+    session = FakeSession(requests.exceptions.ConnectionError("reset"))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        make_client(session).request("test", "POST", "http://service/", data=b"x")
+
+    assert len(session.requests) == 1
+
+
+def test_no_retry_once_breaker_opens(no_sleep):
+    session = FakeSession(503, 503, 503)
+    client = make_client(session, threshold=2, max_retries=2)
+
+    response = client.request("test", "GET", "http://service/")
+
+    assert response.status_code == 503
+    assert len(session.requests) == 2
+    with pytest.raises(CircuitOpenError):
+        client.request("test", "GET", "http://service/")
+
+
+def test_timeout_grows_with_payload_size():
+    session = FakeSession(200, 200)
+    client = make_client(session)
+
+    client.request("test", "POST", "http://service/", data={"source": "x"})
+    adaptive = client.latency["test"].timeout()
+    client.request("test", "POST", "http://service/", data={"source": "x" * (10 * 1024 * 1024)})
+
+    # 10 МБ по 2 с на мегабайт сверх адаптивного таймаута
+    assert session.requests[-1][2] == pytest.approx(adaptive + 20, abs=0.01)
+
+
+def test_status_poll_is_not_retried_inside_request(no_sleep):
+    """Опрос статуса повторяет сам цикл опроса, клиент отдает первый ответ"""
+    session = FakeSession(503)
+    client = ResilientClient(budget=RetryBudget(max_tokens=10))
+    client.session = session
+
+    response = client.request("yesai.poll", "GET", "http://service/task")
+
+    assert response.status_code == 503
+    assert len(session.requests) == 1
@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+from shared_state import RedisBackend, SharedState, SharedStateError, SQLiteBackend, create_backend
+
+
+@pytest.fixture
+def backend(stub):
+    backend = create_backend(f"redis://:secret@127.0.0.1:{stub.port}/2")
+    yield backend
+    backend.close()
+
+
+def test_connect_authenticates_and_selects_db(stub, backend):
+    assert isinstance(backend, RedisBackend)
+    assert backend.get("uploads", "missing") is None
+    assert stub.commands[:2] == [["AUTH", b"secret"], ["SELECT", b"2"]]
+
+
+def test_set_get_roundtrip_with_ttl(stub, backend):
+    backend.set("uploads", "hash", {"url": "https://example.com/a.jpg", "name": "полка.jpg"}, ttl=60)
+
+    assert backend.get("uploads", "hash") == {"url": "https://example.com/a.jpg", "name": "полка.jpg"}
+    assert stub.commands[-2][:2] == ["SET", b"gene:uploads:hash"]
+    assert stub.commands[-2][3:] == [b"EX", b"60"]
+
+
+def test_delete(backend):
+    backend.set("tasks", "t1", {"status": "pending"})
+    backend.delete("tasks", "t1")
+
+    assert backend.get("tasks", "t1") is None
+
+
+def test_blob_roundtrip_keeps_binary_data(backend):
+    data = bytes(range(256)) * 4 + b"\r\n$-1\r\n"
+    backend.put_blob("result_t1", data, ttl=60)
+
+    assert backend.get_blob("result_t1") == data
+    assert backend.get_blob("result_t2") is None
+
+
+def test_reconnects_after_connection_drop(stub, backend):
+    backend.set("tasks", "t1", {"status": "pending"})
+    stub.drop_connections()
+
+    assert backend.get("tasks", "t1") == {"status": "pending"}
+    assert sum(1 for command in stub.commands if command[0] == "AUTH") == 2
+
+
+def test_error_reply_raises(stub):
+    backend = create_backend(f"redis://:wrong@127.0.0.1:{stub.port}/0")
+    with pytest.raises(SharedStateError, match="WRONGPASS"):
+        backend.get("uploads", "hash")
+    backend.close()
+
+
+def test_shared_state_tolerates_backend_errors(stub):
+    state = SharedState(create_backend(f"redis://:wrong@127.0.0.1:{stub.port}/0"))
+
+    assert state.get_upload("hash") is None
+    state.put_upload("hash", "https://example.com/a.jpg", "a.jpg")
+
+
+def test_unreachable_server_raises_oserror():
+    backend = RedisBackend("127.0.0.1", port=1, timeout=1)
+    with pytest.raises(OSError):
+        backend.get("uploads", "hash")
+
+
+def test_sqlite_blob_expires(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "state.sqlite3"))
+    backend.put_blob("result_t1", b"data", ttl=1)
+    backend.put_blob("result_t2", b"data", ttl=None)
+    assert backend.get_blob("result_t1") == b"data"
+
+    time.sleep(1.1)
+    backend.collect_garbage(force=True)
+
+    assert backend.get_blob("result_t1") is None
+    assert backend.get_blob("result_t2") == b"data"
+    assert sorted(path.name for path in (tmp_path / "blobs").iterdir()) == ["result_t2"]
+    backend.close()
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def any_backend(request, tmp_path):
+    if request.param == "sqlite":
+        backend = SQLiteBackend(str(tmp_path / "state.sqlite3"))
+    else:
+        backend = request.getfixturevalue("backend")
+    yield backend
+    backend.close()
+
+
+def test_set_if_absent_keeps_first_value(any_backend):
+    assert any_backend.set_if_absent("secrets", "key", {"value": "first"})
+    assert not any_backend.set_if_absent("secrets", "key", {"value": "second"})
+
+    assert any_backend.get("secrets", "key") == {"value": "first"}
+
+
+def test_set_if_absent_replaces_expired_value(any_backend):
+    any_backend.set("secrets", "key", {"value": "old"}, ttl=1)
+    time.sleep(1.1)
+
+    assert any_backend.set_if_absent("secrets", "key", {"value": "new"})
+    assert any_backend.get("secrets", "key") == {"value": "new"}
+
+
+def test_secret_is_created_once_for_all_replicas(any_backend):
+    replicas = [SharedState(any_backend) for _ in range(8)]
+    results = [None] * len(replicas)
+
+    def read(i):
+        results[i] = replicas[i].get_secret("customer_id")
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(len(replicas))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results[0]) == 32
+    assert set(results) == {results[0]}
+    assert SharedState(any_backend).get_secret("customer_id") == results[0]
@@ -0,0 +1,121 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+class Interrupted(BaseException):
+    """Как StopException Streamlit: прерывание скрипта, а не ошибка функции"""
+
+
+def wait_for_in_flight(flight: SingleFlight, key: str):
+    """Ждет, пока первый вызов key начнет выполняться"""
+    for _ in range(1000):
+        if flight.in_flight(key):
+            return
+        threading.Event().wait(0.005)
+    raise AssertionError("вызов не начался")
+
+
+def wait_for_waiters(flight: SingleFlight, key: str, count: int):
+    """Ждет, пока к вызову key присоединятся count ожидающих"""
+    for _ in range(1000):
+        with flight._lock:
+            if flight._calls[key].waiters >= count:
+                return
+        threading.Event().wait(0.005)
+    raise AssertionError("ожидающие не присоединились")
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        leader = pool.submit(flight.do, "key", work)
+        wait_for_in_flight(flight, "key")
+        followers = [pool.submit(flight.do, "key", work) for _ in range(4)]
+        wait_for_waiters(flight, "key", 4)
+        release.set()
+        results = [leader.result()] + [f.result() for f in followers]
+
+    assert calls == [1]
+    assert results == [("result", False)] + [("result", True)] * 4
+
+
+def test_error_is_raised_for_every_caller():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def work():
+        release.wait(5)
+        raise ValueError("boom")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, "key", work)
+        wait_for_in_flight(flight, "key")
+        follower = pool.submit(flight.do, "key", work)
+        wait_for_waiters(flight, "key", 1)
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(ValueError, match="boom"):
+                future.result()
+
+
+def test_result_is_not_cached():
+    flight = SingleFlight()
+    counter = iter(range(10))
+
+    assert flight.do("key", lambda: next(counter)) == (0, False)
+    assert flight.do("key", lambda: next(counter)) == (1, False)
+    assert not flight.in_flight("key")
+
+
+def test_different_keys_run_independently():
+    flight = SingleFlight()
+    barrier = threading.Barrier(2, timeout=5)
+
+    # Оба вызова должны выполняться одновременно, иначе барьер не пройдет
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(lambda key: flight.do(key, barrier.wait), ["a", "b"]))
+
+    assert sorted(shared for _, shared in results) == [False, False]
+
+
+def test_interrupted_leader_lets_waiter_run_again():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def interrupted():
+        calls.append("leader")
+        release.wait(5)
+        raise Interrupted()
+
+    def work():
+        calls.append("waiter")
+        return "result"
+
+    def lead():
+        with pytest.raises(Interrupted):
+            flight.do("key", interrupted)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(lead)
+        wait_for_in_flight(flight, "key")
+        follower = pool.submit(flight.do, "key", work)
+        wait_for_waiters(flight, "key", 1)
+        release.set()
+        leader.result()
+
+        assert follower.result() == ("result", False)
+    assert calls == ["leader", "waiter"]
+
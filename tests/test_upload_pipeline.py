@@ -0,0 +1,117 @@
+import pytest
+
+import app
+import upload_pipeline
+
+
+@pytest.fixture
+def queued(pipeline):
+    """Фоновые загрузки не начинаются, пока тест не вызовет pipeline.run()"""
+    pipeline.autorun = False
+    return pipeline
+
+
+def submit(result):
+    def upload():
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return upload_pipeline.get_pipeline().submit(upload)
+
+
+def image(name, upload=None):
+    return {"name": name, "file_key": f"{name}_10", "url": None, "verified": False, "upload": upload}
+
+
+def test_settle_without_upload_is_immediate():
+    reference = image("a.jpg")
+
+    assert upload_pipeline.settle(reference)
+    assert reference["url"] is None
+
+
+def test_settle_waits_only_when_asked(queued):
+    reference = image("a.jpg", submit(("https://img.example/a.jpg", True)))
+
+    assert not upload_pipeline.settle(reference)
+    assert reference["upload"] is not None
+
+    queued.run()
+    assert upload_pipeline.settle(reference)
+    assert (reference["url"], reference["verified"], reference["upload"]) == ("https://img.example/a.jpg", True, None)
+
+
+def test_settle_keeps_skipped_verification(pipeline):
+    reference = image("a.jpg", submit(("https://img.example/a.jpg", None)))
+
+    upload_pipeline.settle(reference, wait=True)
+
+    assert reference["verified"] is None
+
+
+@pytest.mark.parametrize("cancelled", [False, True])
+def test_failed_or_cancelled_upload_settles_without_url(queued, cancelled):
+    reference = image("a.jpg", submit(RuntimeError("сеть недоступна")))
+    if cancelled:
+        reference["upload"].cancel()
+    queued.run()
+
+    assert upload_pipeline.settle(reference)
+    assert (reference["url"], reference["verified"], reference["upload"]) == (None, False, None)
+
+
+def test_cancel_skips_started_uploads(queued):
+    started = image("started.jpg", submit(("https://img.example/s.jpg", True)))
+    queued.run()
+    waiting = image("waiting.jpg", submit(("https://img.example/w.jpg", True)))
+
+    assert upload_pipeline.cancel([started, waiting, image("none.jpg")]) == [waiting]
+    assert waiting["upload"] is None
+    assert started["upload"].done()
+
+
+@pytest.fixture
+def selection(session_state, queued, uploaded_file):
+    """Кэш выбранных файлов: b.jpg - дубликат a.jpg и использует его загрузку"""
+    original = image("a.jpg", submit(("https://img.example/a.jpg", True)))
+    duplicate = dict(image("b.jpg", original["upload"]), duplicate_of="a.jpg")
+    other = image("c.jpg", submit(("https://img.example/c.jpg", True)))
+    session_state.uploaded_files_cache = {img["file_key"]: img for img in (original, duplicate, other)}
+
+    def files(*names):
+        return [uploaded_file(name, b"x" * 10) for name in names]
+
+    return original, duplicate, other, files
+
+
+def test_removed_files_uploads_are_cancelled(session_state, selection):
+    original, duplicate, other, files = selection
+
+    app.cancel_removed_uploads(files("a.jpg", "b.jpg"))
+
+    assert other["upload"] is None
+    assert set(session_state.uploaded_files_cache) == {"a.jpg_10", "b.jpg_10"}
+    assert not original["upload"].cancelled()
+
+
+def test_duplicate_keeps_original_upload_alive(session_state, selection):
+    original, duplicate, other, files = selection
+
+    app.cancel_removed_uploads(files("b.jpg", "c.jpg"))
+
+    # Оригинал убран из выбора, но его загрузку использует выбранный дубликат
+    assert not original["upload"].cancelled()
+    assert "a.jpg_10" in session_state.uploaded_files_cache
+    upload_pipeline.get_pipeline().executor.run()
+    assert upload_pipeline.settle(duplicate)
+    assert duplicate["url"] == "https://img.example/a.jpg"
+
+
+def test_removing_everything_cancels_shared_upload(session_state, selection):
+    original, duplicate, other, files = selection
+
+    app.cancel_removed_uploads([])
+
+    assert original["upload"] is duplicate["upload"] is other["upload"] is None
+    assert session_state.uploaded_files_cache == {}
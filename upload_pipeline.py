@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Callable, Iterable, List
+from urllib.parse import urlsplit
+
+import resilience
+
+logger = logging.getLogger(__name__)
+
+# Потоки фоновой загрузки референсов (общие для всех сессий процесса)
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "8"))
+# Как часто заново прогревать соединение с одним адресом (сек)
+WARM_UP_INTERVAL = 30
+
+
+class UploadPipeline:
+    """
+    Фоновая подготовка референсов, пока пользователь пишет промпт:
+    загрузка и проверка ссылок в пуле потоков и прогрев соединений с внешними сервисами.
+    """
+
+    def __init__(self, workers: int = UPLOAD_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+        self._warmed_at = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self.executor.submit(fn, *args)
+
+    def warm_up(self, urls: Iterable[str]) -> None:
+        """Заранее открывает соединения (TCP и TLS), чтобы первый запрос не тратил на это время"""
+        # Соединения переиспользуются в пределах хоста, поэтому прогреваем корень сервиса
+        origins = {f"{parts.scheme}://{parts.netloc}/" for parts in map(urlsplit, urls)}
+        now = time.time()
+        with self._lock:
+            due = [url for url in origins if now - self._warmed_at.get(url, 0) >= WARM_UP_INTERVAL]
+            for url in due:
+                self._warmed_at[url] = now
+        for url in due:
+            self.executor.submit(resilience.get_client().warm_up, url)
+
+
+def settle(reference: dict, wait: bool = False) -> bool:
+    """
+    Переносит итог фоновой загрузки (url, verified) в описание изображения.
+    Возвращает False, если загрузка еще выполняется и wait=False.
+    """
+    future = reference.get("upload")
+    if future is None:
+        return True
+    if not wait and not future.done():
+        return False
+
+    try:
+        url, verified = future.result()
+    except CancelledError:
+        url, verified = None, False
+    except Exception as e:
+        logger.warning(f"Фоновая загрузка {reference.get('name')} завершилась ошибкой: {e}")
+        url, verified = None, False
+
+    reference.update(url=url, verified=verified, upload=None)
+    return True
+
+
+def cancel(references: List[dict]) -> List[dict]:
+    """Отменяет еще не начатые фоновые загрузки; возвращает изображения, загрузка которых отменена"""
+    cancelled = [ref for ref in references if ref.get("upload") is not None and ref["upload"].cancel()]
+    for reference in cancelled:
+        reference["upload"] = None
+    if cancelled:
+        logger.info(f"Отменено фоновых загрузок: {len(cancelled)}")
+    return cancelled
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline() -> UploadPipeline:
+    """Общий пул процесса: число одновременных загрузок не растет с числом сессий"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = UploadPipeline()
+        return _pipeline